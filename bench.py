@@ -0,0 +1,137 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# #  FileName    : bench.py
+# #  Author      : ShuYu Wang <andelf@gmail.com>
+# #  Created     : Fri May 22 16:20:05 2015 by ShuYu Wang
+# #  Copyright   : Feather Workshop (c) 2015
+# #  Description : 离线回放截图, 测量各逻辑的决策耗时
+
+import os
+import sys
+import json
+import time
+import codecs
+import optparse
+
+from PIL import Image
+import numpy as np
+
+import templates
+import main
+from main import RecordingGame, OpenCVImageMatcher
+
+
+DEFAULT_FRAMES = ["./login.png", "./sanjieqiyuan.png", "./2.png"]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def create_logics(names):
+    """name -> 决策函数 func(game)"""
+    logics = []
+    for name in names:
+        if name == "loop":
+            logics.append((name, main.loop))
+        elif name == "switch_account":
+            logics.append((name, main.loop_SwitchAccount))
+        else:
+            logic = main.LOGICS[name]()
+            if hasattr(logic, "bank"):
+                # 回放时不保存未知题目截图
+                logic.bank.unknown_dir = None
+            logics.append((name, logic.loop))
+    return logics
+
+
+def run_once(decide, frame, cold):
+    if cold:
+        main.scene_cache = main.SceneCache()
+    game = RecordingGame(None, frame)
+    counters = dict(OpenCVImageMatcher.counters)
+
+    start_time = time.time()
+    sleep_after = decide(game)
+    elapsed = time.time() - start_time
+
+    actions = []
+    for name, args, _ in game.recorded:
+        if name == "schedule":
+            # 动作序列展开成各个步骤
+            sequence = args[0]
+            actions.append(["schedule", [sequence.name]])
+            actions.extend([step, list(step_args)] for step, step_args, _ in sequence.steps)
+        else:
+            actions.append([name, list(args)])
+    matches = OpenCVImageMatcher.counters["computed"] - counters["computed"]
+    return elapsed, matches, sleep_after, actions
+
+
+def bench(name, decide, path, frame, repeat, cold):
+    latencies = []
+    matches = []
+    for _ in range(repeat):
+        elapsed, computed, sleep_after, actions = run_once(decide, frame, cold)
+        latencies.append(elapsed * 1000.0)
+        matches.append(computed)
+    return dict(logic=name, frame=path, runs=repeat,
+                first_ms=latencies[0],
+                p50_ms=percentile(latencies, 0.50),
+                p95_ms=percentile(latencies, 0.95),
+                p99_ms=percentile(latencies, 0.99),
+                matches_per_frame=float(sum(matches)) / repeat,
+                sleep_after=sleep_after, actions=actions)
+
+
+def run(argv):
+    parser = optparse.OptionParser(usage="%prog [options] [screenshot.png ...]")
+    parser.add_option("-n", "--repeat", type="int", default=20,
+                      help="runs per logic and frame (default 20)")
+    parser.add_option("-l", "--logic", action="append", default=None,
+                      help="loop, switch_account or a name in main.LOGICS; may repeat (default all)")
+    parser.add_option("-o", "--output", default=None,
+                      help="write JSON results to this file (default stdout)")
+    parser.add_option("--cold", action="store_true", default=False,
+                      help="clear the scene cache before every run")
+    options, args = parser.parse_args(argv[1:])
+
+    frames = args or [path for path in DEFAULT_FRAMES if os.path.exists(path)]
+    names = options.logic or ["loop", "switch_account"] + sorted(main.LOGICS)
+
+    start_time = time.time()
+    count = templates.store.preload()
+    load_time = time.time() - start_time
+
+    logics = create_logics(names)
+    results = []
+    stdout = sys.stdout
+    # 逻辑中的 print 不混进 JSON 输出
+    sys.stdout = codecs.getwriter("utf-8")(open(os.devnull, "w"))
+    try:
+        for path in frames:
+            frame = np.asarray(Image.open(path).convert("RGB"))
+            for name, decide in logics:
+                results.append(bench(name, decide, path, frame, options.repeat, options.cold))
+    finally:
+        sys.stdout = stdout
+
+    report = dict(created_at=time.strftime("%Y-%m-%d %H:%M:%S"), repeat=options.repeat,
+                  cold=options.cold, templates=count, template_load_s=load_time,
+                  results=results)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as fp:
+            fp.write(output + "\n")
+        for item in results:
+            print "%-16s %-22s p50=%7.2fms p95=%7.2fms p99=%7.2fms matches=%5.1f" % (
+                item["logic"], item["frame"], item["p50_ms"], item["p95_ms"],
+                item["p99_ms"], item["matches_per_frame"])
+    else:
+        print output
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(run(sys.argv))
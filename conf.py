@@ -1,3 +1,4 @@
+# -*- coding: utf-8 -*-
 ip = "192.168.1.101"
 #ip = "10.6.185.231"
 #ip = "192.168.199.160"
@@ -6,6 +7,75 @@ port = 5900
 
 password = "123456"
 
+# 场景规则表, None 为 main.py 同目录的 rules.json
+rules_file = None
+
+# 游戏逻辑: None 为默认日常 loop, 或 main.LOGICS 中的名字, 如 "sanjieqiyuan"
+logic = None
+
+# 三界奇缘: 不在题库中的题目截图保存目录, None 不保存
+sanjieqiyuan_unknown_dir = "./sanjieqiyuan/unknown"
+
+# 预编译模板包, 由 python templates.py build 生成, 不存在时直接解码 PNG
+template_pack = "./templates.pack"
+
+# 场景缓存预热截图目录, 子目录为 battle / normal / special / transition
+scene_seed_dir = None
+
+# 逻辑只关注部分区域时, 至少每隔这么多秒做一次全屏刷新
+full_refresh_interval = 30.0
+
+# 全屏模板搜索的金字塔缩放比例, 如 0.5 或 0.25; None 关闭
+# 开启前用 python verify_pyramid.py <截图...> 核对结果
+pyramid_scale = None
+
+# VNC 像素格式: "rgb888"(默认), "rgb565"(16 位), "rgb332"(8 位)
+# 低位深可减少 2-4 倍流量, 模板会按同样方式量化; 模板包需用同一格式重新生成
+pixel_format = "rgb888"
+
+# 帧请求间隔范围(秒), 以及有点击动作后等待画面响应的最短时间
+poll_min = 0.1
+poll_max = 15.0
+poll_settle = 1.0
+
+# 点击节奏(秒): 按下保持时间, 相邻两次点击的间隔
+tap_hold = 0.02
+tap_gap = 0.03
+
+# 画面未变化时跳过决策, 最多沿用上次决策这么多秒
+max_stale = 20.0
+
+# 多设备: 一个进程驱动多台 iPad, 共享模板库; 为空时使用上面的 ip/port/logic
+# devices = [
+#     dict(name="ipad1", ip="192.168.1.101", port=5900, password="123456", logic=None),
+#     dict(name="ipad2", ip="192.168.1.102", port=5900, password="123456", logic="sanjieqiyuan"),
+# ]
+devices = []
+
+# 所有设备匹配耗时的上限, 单核占用比例 (如 0.8), None 不限制
+match_cpu_limit = None
+# 设备吞吐、规则耗时统计的日志间隔(秒)
+stats_interval = 60.0
+
+# 本地纯文本指标端口 (http://127.0.0.1:<port>/), 每个模板/RECT 的匹配耗时和各阶段耗时; None 关闭
+metrics_port = None
+
+# 决策记录: 保留最近多少帧; 同一决策连续多少次视为卡住, 记录和画面写到 trace_dump_dir
+trace_size = 200
+stuck_repeat = 10
+trace_dump_dir = "./traces"
+
+# 切换帐号时从 account.db 租用下一个帐号 (见 db.py, 需要 peewee), 关闭时输入 loop_SwitchAccount 里的固定帐号;
+# 租约有效期(秒), 运行中定期续约
+account_pool = False
+account_lease_time = 600
+
+# 画面分析在哪里运行: "reactor" 同步执行; "thread" 交给线程池, reactor 保持响应
+analysis = "reactor"
+analysis_threads = 4
+# thread 模式下分析期间到达新帧会丢弃旧结果重新分析, 连续丢弃这么多次后仍采用结果
+analysis_max_drops = 3
+
 
 
 # accounts = [
@@ -4,7 +4,7 @@
 # #  Author      : ShuYu Wang <andelf@gmail.com>
 # #  Created     : Mon May  4 21:35:06 2015 by ShuYu Wang
 # #  Copyright   : Feather Workshop (c) 2015
-# #  Description : description
+# #  Description : 帐号库, 以及多设备之间的帐号租用
 # #  Time-stamp: <2015-05-07 10:33:01 andelf>
 
 
@@ -40,7 +40,7 @@ class Account(BaseModel):
 
 
     def finish_routine_work(self, started_at, memo=""):
-        RoutineWork.create(account = self, started_at, memo=memo)
+        RoutineWork.create(account = self, started_at = started_at, memo=memo)
 
 
 class RoutineWork(BaseModel):
@@ -51,11 +51,95 @@ class RoutineWork(BaseModel):
 
     memo = CharField(null=True)
 
+    class Meta:
+        indexes = (
+            # 租用时按帐号查当天是否已完成
+            (("account", "date"), False),
+        )
+
+
+class AccountLease(BaseModel):
+    """帐号租约, 每个帐号一行; device 为空或 expires_at 已过期表示可租用"""
+    account = ForeignKeyField(Account, related_name='leases', unique=True)
+    device = CharField(null=True)
+    expires_at = DateTimeField(null=True, index=True)
+    last_run_at = DateTimeField(null=True, index=True)
+
+
+# 租约有效期(秒), 需要定期 heartbeat 续约
+LEASE_TIME = 600
+
+
+def eligible_accounts(now=None, limit=10):
+    """可租用的帐号: 启用、当天没有 RoutineWork、没有有效租约, 最久没运行的在前"""
+    now = now or datetime.datetime.now()
+    done_today = (RoutineWork
+                  .select(RoutineWork.id)
+                  .where((RoutineWork.account == Account.id) &
+                         (RoutineWork.date == now.date())))
+    return (Account
+            .select()
+            .join(AccountLease, JOIN_LEFT_OUTER)
+            .where((Account.is_active == True) &
+                   ((AccountLease.id >> None) | (AccountLease.expires_at >> None) |
+                    (AccountLease.expires_at < now)) &
+                   ~fn.EXISTS(done_today))
+            .order_by(AccountLease.last_run_at, Account.id)
+            .limit(limit))
+
+
+def lease(device, seconds=LEASE_TIME, candidates=10):
+    """为 device 租用下一个帐号, 没有可用帐号时返回 None
+
+    先查出若干候选, 再逐个用带过期条件的 UPDATE 抢占（或 INSERT 新租约,
+    由 account 的唯一约束保证只有一台设备成功）, 多设备同时租用也不会拿到同一帐号。
+    """
+    now = datetime.datetime.now()
+    expires_at = now + datetime.timedelta(seconds=seconds)
+    for account in list(eligible_accounts(now, candidates)):
+        with db.transaction():
+            updated = (AccountLease
+                       .update(device=device, expires_at=expires_at)
+                       .where((AccountLease.account == account) &
+                              ((AccountLease.expires_at >> None) |
+                               (AccountLease.expires_at < now)))
+                       .execute())
+            if not updated:
+                try:
+                    AccountLease.create(account=account, device=device, expires_at=expires_at)
+                except IntegrityError:
+                    # 已被其他设备租走
+                    continue
+        return account
+    return None
+
+
+def heartbeat(account, device, seconds=LEASE_TIME):
+    """续约, 返回 False 表示租约已过期并被其他设备取得"""
+    expires_at = datetime.datetime.now() + datetime.timedelta(seconds=seconds)
+    return (AccountLease
+            .update(expires_at=expires_at)
+            .where((AccountLease.account == account) & (AccountLease.device == device))
+            .execute()) > 0
+
+
+def release(account, device, finished=True):
+    """归还租约; finished 时记录运行时间, 下次排到最后"""
+    values = dict(device=None, expires_at=None)
+    if finished:
+        values["last_run_at"] = datetime.datetime.now()
+    return (AccountLease
+            .update(**values)
+            .where((AccountLease.account == account) & (AccountLease.device == device))
+            .execute()) > 0
 
 
 def create():
     db.connect()
-    db.create_tables([Account, RoutineWork], safe=True)
+    db.create_tables([Account, RoutineWork, AccountLease], safe=True)
+    # 已有的 account.db 里 RoutineWork 表不会重建, 单独补上索引
+    db.execute_sql("CREATE INDEX IF NOT EXISTS routinework_account_id_date "
+                   "ON routinework (account_id, date)")
 
 def initdb():
     import csv
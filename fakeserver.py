@@ -0,0 +1,362 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# #  FileName    : fakeserver.py
+# #  Author      : ShuYu Wang <andelf@gmail.com>
+# #  Created     : Sat May 23 11:05:37 2015 by ShuYu Wang
+# #  Copyright   : Feather Workshop (c) 2015
+# #  Description : 本地 RFB 服务器, 用截图代替 iPad 做端到端测试
+
+import os
+import sys
+import glob
+import json
+import time
+import struct
+import optparse
+
+from twisted.internet import reactor, protocol, task
+
+import cv2
+import numpy as np
+
+import pixfmt
+
+
+# 服务器初始像素格式, 客户端一般会用 SetPixelFormat 改掉
+SERVER_FORMAT = dict(bpp=32, depth=24, bigendian=0, truecolor=1,
+                     redmax=255, greenmax=255, bluemax=255,
+                     redshift=16, greenshift=8, blueshift=0)
+
+PIXEL_FORMAT = struct.Struct("!BBBBHHHBBBxxx")
+PIXEL_FORMAT_KEYS = ("bpp", "depth", "bigendian", "truecolor",
+                     "redmax", "greenmax", "bluemax",
+                     "redshift", "greenshift", "blueshift")
+
+# 客户端消息类型 -> 消息头剩余长度
+MESSAGE_SIZES = {0: 19, 2: 3, 3: 9, 4: 7, 5: 5, 6: 7}
+
+ENCODING_RAW = 0
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def changed_rect(a, b, rect):
+    """rect 内 a, b 不同部分的外接矩形, 没有变化时为 None"""
+    x, y, w, h = rect
+    diff = np.any(a[y: y + h, x: x + w] != b[y: y + h, x: x + w], axis=2)
+    rows = np.flatnonzero(diff.any(axis=1))
+    if not len(rows):
+        return None
+    cols = np.flatnonzero(diff.any(axis=0))
+    return (x + int(cols[0]), y + int(rows[0]),
+            int(cols[-1] - cols[0]) + 1, int(rows[-1] - rows[0]) + 1)
+
+
+class FakeRFBServer(protocol.Protocol):
+    """RFB 3.3/3.7/3.8, 无认证, 只发送 Raw 编码
+
+    增量请求在请求区域没有变化时挂起, 直到画面切换到下一帧。
+    """
+    def connectionMade(self):
+        self.buffer = ""
+        self.expect(self.handleVersion, 12)
+        self.transport.write("RFB 003.008\n")
+
+        self.pixel_format = pixfmt.from_params(SERVER_FORMAT)
+        # 客户端当前持有的画面, 用于计算增量更新
+        self.client_frame = None
+        # 挂起的增量请求: (rect, 收到时间)
+        self.pending = None
+
+        self.connected_at = time.time()
+        self.bytes_sent = 0
+        self.updates = 0
+        self.requests = 0
+        self.pointer_events = 0
+        self.key_events = 0
+        self.buttons = 0
+        # 最近一次更新的发送时间, 以及它之后是否已收到输入
+        self.updated_at = None
+        self.answered = True
+        # 请求 -> 更新, 更新 -> 第一个输入
+        self.request_latency = []
+        self.input_latency = []
+
+        self.factory.clients.append(self)
+        print "client connected:", self.transport.getPeer()
+
+    def connectionLost(self, reason):
+        if self in self.factory.clients:
+            self.factory.clients.remove(self)
+        self.report()
+        print "client disconnected"
+
+    def expect(self, handler, size):
+        self.handler = handler
+        self.expected = size
+
+    def dataReceived(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.expected:
+            block, self.buffer = self.buffer[:self.expected], self.buffer[self.expected:]
+            self.handler(block)
+
+    # 握手
+    def handleVersion(self, block):
+        if block.startswith("RFB 003.003"):
+            self.version = (3, 3)
+        elif block.startswith("RFB 003.007"):
+            self.version = (3, 7)
+        else:
+            self.version = (3, 8)
+        if self.version == (3, 3):
+            self.transport.write(struct.pack("!I", 1))
+            self.expect(self.handleClientInit, 1)
+        else:
+            self.transport.write(struct.pack("!BB", 1, 1))
+            self.expect(self.handleSecurityType, 1)
+
+    def handleSecurityType(self, block):
+        if ord(block) != 1:
+            print "unsupported security type:", ord(block)
+            self.buffer = ""
+            self.transport.loseConnection()
+            return
+        if self.version >= (3, 8):
+            self.transport.write(struct.pack("!I", 0))
+        self.expect(self.handleClientInit, 1)
+
+    def handleClientInit(self, block):
+        height, width = self.factory.frame.shape[:2]
+        name = self.factory.name
+        self.transport.write(struct.pack("!HH", width, height) +
+                             PIXEL_FORMAT.pack(*[SERVER_FORMAT[key] for key in PIXEL_FORMAT_KEYS]) +
+                             struct.pack("!I", len(name)) + name)
+        self.expect(self.handleMessage, 1)
+
+    # 客户端消息
+    def handleMessage(self, block):
+        kind = ord(block)
+        size = MESSAGE_SIZES.get(kind)
+        if size is None:
+            print "unknown client message:", kind
+            self.buffer = ""
+            self.transport.loseConnection()
+            return
+        handler = {0: self.handleSetPixelFormat, 2: self.handleSetEncodings,
+                   3: self.handleUpdateRequest, 4: self.handleKeyEvent,
+                   5: self.handlePointerEvent, 6: self.handleCutText}[kind]
+        self.expect(handler, size)
+
+    def handleSetPixelFormat(self, block):
+        params = dict(zip(PIXEL_FORMAT_KEYS, PIXEL_FORMAT.unpack(block[3:])))
+        self.pixel_format = pixfmt.from_params(params)
+        print "pixel format: %s (%d bpp)" % (self.pixel_format.name, self.pixel_format.bpp)
+        self.expect(self.handleMessage, 1)
+
+    def handleSetEncodings(self, block):
+        count, = struct.unpack("!xH", block)
+        if count:
+            self.expect(self.handleEncodings, 4 * count)
+        else:
+            self.expect(self.handleMessage, 1)
+
+    def handleEncodings(self, block):
+        # 只发送 Raw, 所有客户端都必须支持
+        self.expect(self.handleMessage, 1)
+
+    def handleUpdateRequest(self, block):
+        incremental, x, y, w, h = struct.unpack("!BHHHH", block)
+        self.requests += 1
+        self.pending = ((x, y, w, h), time.time())
+        if not incremental:
+            self.client_frame = None
+        self.flush()
+        self.expect(self.handleMessage, 1)
+
+    def handleKeyEvent(self, block):
+        down, key = struct.unpack("!BxxI", block)
+        self.key_events += 1
+        self.inputReceived("key", key=key, down=down)
+        self.expect(self.handleMessage, 1)
+
+    def handlePointerEvent(self, block):
+        buttons, x, y = struct.unpack("!BHH", block)
+        self.pointer_events += 1
+        released = self.buttons and not buttons
+        self.buttons = buttons
+        self.inputReceived("pointer", x=x, y=y, buttons=buttons)
+        if released:
+            self.factory.clicked()
+        self.expect(self.handleMessage, 1)
+
+    def handleCutText(self, block):
+        length, = struct.unpack("!xxxI", block)
+        if length:
+            self.expect(self.handleCutTextData, length)
+        else:
+            self.expect(self.handleMessage, 1)
+
+    def handleCutTextData(self, block):
+        self.expect(self.handleMessage, 1)
+
+    def inputReceived(self, kind, **event):
+        now = time.time()
+        if not self.answered and self.updated_at is not None:
+            self.input_latency.append(now - self.updated_at)
+            self.answered = True
+        event.update(t=now, type=kind, frame=self.factory.index)
+        self.factory.record(event)
+
+    # 帧更新
+    def flush(self):
+        """有挂起的请求且请求区域有变化时发送更新"""
+        if self.pending is None:
+            return
+        rect, requested_at = self.pending
+        frame = self.factory.frame
+        height, width = frame.shape[:2]
+        x, y, w, h = rect
+        w, h = min(w, width - x), min(h, height - y)
+        if w <= 0 or h <= 0:
+            return
+        if self.client_frame is None:
+            self.client_frame = np.zeros_like(frame)
+            dirty = (x, y, w, h)
+        else:
+            dirty = changed_rect(frame, self.client_frame, (x, y, w, h))
+            if dirty is None:
+                return
+
+        x, y, w, h = dirty
+        data = self.pixel_format.tobytes(frame[y: y + h, x: x + w])
+        self.transport.write(struct.pack("!BxH", 0, 1) +
+                             struct.pack("!HHHHi", x, y, w, h, ENCODING_RAW) + data)
+        self.client_frame[y: y + h, x: x + w] = frame[y: y + h, x: x + w]
+
+        now = time.time()
+        self.pending = None
+        self.bytes_sent += 16 + len(data)
+        self.updates += 1
+        self.request_latency.append(now - requested_at)
+        self.updated_at = now
+        self.answered = False
+
+    def stats(self):
+        minutes = max(time.time() - self.connected_at, 1.0) / 60.0
+        return dict(peer=str(self.transport.getPeer()), pixel_format=self.pixel_format.name,
+                    bytes_sent=self.bytes_sent, updates=self.updates, requests=self.requests,
+                    frames_per_min=self.updates / minutes,
+                    bytes_per_min=self.bytes_sent / minutes,
+                    pointer_events=self.pointer_events, key_events=self.key_events,
+                    request_to_update_p50=percentile(self.request_latency, 0.5),
+                    request_to_update_p95=percentile(self.request_latency, 0.95),
+                    update_to_input_p50=percentile(self.input_latency, 0.5),
+                    update_to_input_p95=percentile(self.input_latency, 0.95))
+
+    def report(self):
+        print "%(peer)s %(pixel_format)s: %(updates)d updates (%(frames_per_min).1f/min), " \
+              "%(bytes_sent)d bytes (%(bytes_per_min).0f/min), " \
+              "request->update p50=%(request_to_update_p50).3fs p95=%(request_to_update_p95).3fs, " \
+              "update->input p50=%(update_to_input_p50).3fs p95=%(update_to_input_p95).3fs, " \
+              "%(pointer_events)d pointer / %(key_events)d key events" % self.stats()
+
+
+class FakeRFBFactory(protocol.ServerFactory):
+    protocol = FakeRFBServer
+
+    def __init__(self, frames, name="xyq-fake", events=None, advance_on_click=False):
+        self.paths = frames
+        self.frames = [self.load(path) for path in frames]
+        self.name = name
+        self.index = 0
+        self.clients = []
+        self.advance_on_click = advance_on_click
+        self.events = open(events, "a") if events else None
+
+    @staticmethod
+    def load(path):
+        img = cv2.imread(path)
+        if img is None:
+            raise IOError("can not read frame: %s" % path)
+        return img
+
+    @property
+    def frame(self):
+        return self.frames[self.index]
+
+    def advance(self):
+        """切换到下一帧, 给挂起请求的客户端发送更新"""
+        if len(self.frames) < 2:
+            return
+        self.index = (self.index + 1) % len(self.frames)
+        print "frame %d: %s" % (self.index, self.paths[self.index])
+        for client in self.clients:
+            client.flush()
+
+    def clicked(self):
+        if self.advance_on_click:
+            self.advance()
+
+    def record(self, event):
+        if self.events is not None:
+            self.events.write(json.dumps(event) + "\n")
+            self.events.flush()
+
+    def report(self):
+        for client in self.clients:
+            client.report()
+
+
+def expand_frames(args):
+    frames = []
+    for arg in args:
+        if os.path.isdir(arg):
+            frames.extend(sorted(glob.glob(os.path.join(arg, "*.png"))))
+        else:
+            frames.append(arg)
+    return frames
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options] frame.png|dir ...")
+    parser.add_option("-p", "--port", type="int", default=5900,
+                      help="listen port (default 5900)")
+    parser.add_option("-l", "--listen", default="127.0.0.1",
+                      help="listen address (default 127.0.0.1)")
+    parser.add_option("-i", "--interval", type="float", default=0,
+                      help="advance to the next frame every N seconds (default off)")
+    parser.add_option("-c", "--advance-on-click", action="store_true", default=False,
+                      help="advance to the next frame on every pointer release")
+    parser.add_option("-e", "--events", default=None,
+                      help="append received pointer/key events to this JSON lines file")
+    parser.add_option("-r", "--report", type="float", default=30.0,
+                      help="print client statistics every N seconds (default 30)")
+    options, args = parser.parse_args(argv[1:])
+
+    frames = expand_frames(args or ["./login.png"])
+    factory = FakeRFBFactory(frames, events=options.events,
+                             advance_on_click=options.advance_on_click)
+    shapes = set(frame.shape for frame in factory.frames)
+    if len(shapes) > 1:
+        print "all frames must have the same size:", sorted(shapes)
+        return 1
+
+    if options.interval > 0:
+        task.LoopingCall(factory.advance).start(options.interval, now=False)
+    if options.report > 0:
+        task.LoopingCall(factory.report).start(options.report, now=False)
+
+    reactor.listenTCP(options.port, factory, interface=options.listen)
+    print "serving %d frames on %s:%d" % (len(frames), options.listen, options.port)
+    reactor.run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -9,6 +9,8 @@
 
 import random
 import time
+import copy
+import datetime
 import getpass
 import optparse
 import sys
@@ -19,9 +21,14 @@ import logging.handlers
 import math
 import collections
 import socket
+import glob
+import zlib
+import threading
+import struct
+import json
 
 from twisted.python.log import PythonLoggingObserver
-from twisted.internet import reactor, protocol, defer
+from twisted.internet import reactor, protocol, task, threads
 from twisted.python import log
 from twisted.python.failure import Failure
 from twisted.protocols.policies import TimeoutMixin
@@ -36,6 +43,9 @@ import cv2
 import numpy as np
 
 import conf
+import templates
+import pixfmt
+import metrics
 
 
 socket.setdefaulttimeout(20.0)
@@ -127,56 +137,327 @@ class RECTS(object):
     SanJieQiYuanAnswer = (752, 686, 453, 1239)
     SanJieQiYuanQuestion = (1169, 812, 100, 1050)
 
-class OpenCVImageMatcher(object):
-    def __init__(self, img):
-        if isinstance(img, Image.Image):
-            cv_img = np.array(img)
-            self.img = cv2.cvtColor(cv_img, cv2.cv.CV_BGR2RGB)
-        else:
-            self.img = cv2.imread(imgfile)
-        self.img_gray = cv2.cvtColor(self.img, cv2.COLOR_BGR2GRAY)
+# rect -> RECTS 中的名字, 用于统计输出
+RECT_NAMES = dict((rect, name) for name, rect in vars(RECTS).items() if not name.startswith("_"))
 
-    def match_sub_image(self, imgfile, threshold = 0.8):
-        template = cv2.imread(imgfile, 0)
-        res = cv2.matchTemplate(self.img_gray, template, cv2.TM_CCOEFF_NORMED)
+# 离线使用 (没有设备) 时的匹配统计
+DEFAULT_METRICS = metrics.Metrics(rect_names=RECT_NAMES)
+
+
+def bounding_rect(rects):
+    x0 = min(x for x, y, w, h in rects)
+    y0 = min(y for x, y, w, h in rects)
+    x1 = max(x + w for x, y, w, h in rects)
+    y1 = max(y + h for x, y, w, h in rects)
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def rect_intersects(a, b):
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    return ax < bx + bw and bx < ax + aw and ay < by + bh and by < ay + ah
+
+
+class MatchCache(object):
+    """跨帧的匹配结果缓存
+
+    结果按 (模板, rect) 保存, 只有服务器发来的脏矩形与 rect 相交时才失效,
+    静止区域（如 RECTS.LeftIcons, RECTS.TopIcons 的图标）不必每帧重新匹配。
+    rect 为 None 表示全屏, 任何更新都会使其失效。
+    """
+    def __init__(self, max_age=60.0, maxsize=1024):
+        self.max_age = max_age
+        self.maxsize = maxsize
+        # key -> (found, stored_at)
+        self._entries = dict()
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or time.time() - entry[1] > self.max_age:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0]
+
+    def __setitem__(self, key, found):
+        if len(self._entries) >= self.maxsize:
+            self._entries.clear()
+        self._entries[key] = (found, time.time())
+
+    def invalidate(self, rectangles):
+        """rectangles: commitUpdate 收到的 [(x, y, w, h), ...], None 表示全部失效"""
+        if rectangles is None:
+            self.invalidated += len(self._entries)
+            self._entries.clear()
+            return
+        if not rectangles:
+            return
+        for key in self._entries.keys():
+            rect = key[1]
+            if rect is None or any(rect_intersects(rect, dirty) for dirty in rectangles):
+                del self._entries[key]
+                self.invalidated += 1
+
+    def stats(self):
+        return dict(size=len(self._entries), hits=self.hits, misses=self.misses,
+                    invalidated=self.invalidated)
+
+
+# 金字塔匹配: 缩小后模板短边小于此值时退回原图匹配
+PYRAMID_MIN_SIZE = 12
+# 金字塔匹配: 粗匹配后在原图上精确验证的候选数
+PYRAMID_CANDIDATES = 3
 
-        loc = np.where( res >= threshold)
 
-        for x, y in zip(*loc[::-1]):
-            return x, y
+# 场景过渡进度条的检测点 (x = 3)
+TRANSITION_PROBES = [40, 80, 536, 939, 1254, 1733, 1908, 2034]
+
+
+class MatchResult(collections.namedtuple("MatchResult", "imgfile score pos threshold")):
+    __slots__ = ()
+
+    @property
+    def hit(self):
+        return self.score >= self.threshold
+
+
+class MatchTable(list):
+    """match_many 的结果，按分数从高到低排列"""
+
+    def get(self, imgfile):
+        name = templates.template_name(imgfile)
+        for result in self:
+            if templates.template_name(result.imgfile) == name:
+                return result
+        raise KeyError(imgfile)
+
+    def pos(self, imgfile):
+        """与 match_sub_image_in_rect 相同：命中返回位置，否则 None"""
+        result = self.get(imgfile)
+        if result.hit:
+            return result.pos
         return None
 
-    def match_sub_image_in_rect(self, imgfile, rect, threshold = 0.8):
+    def hits(self):
+        return [result for result in self if result.hit]
 
-        template = cv2.imread(imgfile, 0)
 
-        # http://stackoverflow.com/questions/19098104/python-opencv2-cv2-wrapper-get-image-size
-        height, width = self.img_gray.shape
+class OpenCVImageMatcher(object):
+    # 所有 matcher 累计: 实际匹配次数 / 被帧内缓存省掉的次数
+    counters = dict(computed=0, saved=0)
+
+    def __init__(self, img, store=None, cache=None, pyramid=None, gray=None, metrics=None,
+                 trace=None):
+        self.store = store or templates.store
+        # 每个 (模板, rect) 的匹配耗时、分数分布、命中率
+        self.metrics = metrics or DEFAULT_METRICS
+        # 当前帧的决策记录, 见 DecisionTracer
+        self.trace = trace
+        # 全屏搜索时先在 pyramid 倍缩小的图上粗找, 再在原图上精确定位
+        self.pyramid = pyramid
+        self._scaled_gray = dict()
+        # (模板, rect) -> (score, pos)
+        # 默认为帧内缓存, 与 matcher 同生命周期; 传入 MatchCache 则跨帧复用
+        self.memo = cache if cache is not None else dict()
+        self.computed = 0
+        self.saved = 0
+        # self.img 为 RGB, 可以直接是 VNCXyqClient.frame 的视图
+        if isinstance(img, Image.Image):
+            self.img = np.asarray(img.convert("RGB"))
+        elif isinstance(img, basestring):
+            self.img = cv2.cvtColor(cv2.imread(img), cv2.COLOR_BGR2RGB)
+        else:
+            self.img = img
+        if gray is None:
+            gray = cv2.cvtColor(self.img, cv2.COLOR_RGB2GRAY)
+        self.img_gray = gray
+
+    def crop(self, rect=None):
+        """灰度图上 rect 区域的视图, 以及 rect 的偏移"""
+        if rect is None:
+            return self.img_gray, (0, 0)
         # http://stackoverflow.com/questions/15589517/how-to-crop-an-image-in-opencv-using-python
         x, y, w, h = rect
-        cropped_img_gray = self.img_gray[y: y + h, x: x + w]
+        return self.img_gray[y: y + h, x: x + w], (x, y)
+
+    def match_result(self, imgfile, rect=None):
+        """matchTemplate 结果图, 以及 rect 的偏移"""
+        template = self.store.get(imgfile)
+        img_gray, offset = self.crop(rect)
+        res = cv2.matchTemplate(img_gray, template, cv2.TM_CCOEFF_NORMED)
+        return res, offset
+
+    def scaled_gray(self, scale):
+        img = self._scaled_gray.get(scale)
+        if img is None:
+            img = self._scaled_gray[scale] = cv2.resize(self.img_gray, None, fx=scale, fy=scale,
+                                                        interpolation=cv2.INTER_AREA)
+        return img
+
+    def _peaks(self, res, shape, k, threshold):
+        """res 中最高的 k 个峰值, 每个峰值周围模板一半大小的邻域被抹掉"""
+        th, tw = shape
+        found = []
+        for _ in range(k):
+            _, score, _, (mx, my) = cv2.minMaxLoc(res)
+            if score < threshold:
+                break
+            found.append((score, (mx, my)))
+            res[max(0, my - th // 2): my + th // 2 + 1,
+                max(0, mx - tw // 2): mx + tw // 2 + 1] = -1.0
+        return found
+
+    def _best_pyramid(self, imgfile):
+        scale = self.pyramid
+        template = self.store.get(imgfile)
+        th, tw = template.shape
+        if min(th, tw) * scale < PYRAMID_MIN_SIZE:
+            return None
 
-        res = cv2.matchTemplate(cropped_img_gray, template, cv2.TM_CCOEFF_NORMED)
-        loc = np.where( res >= threshold)
+        small_template = self.store.get_scaled(imgfile, scale)
+        res = cv2.matchTemplate(self.scaled_gray(scale), small_template, cv2.TM_CCOEFF_NORMED)
+
+        # 在原图上候选位置附近 margin 像素内精确匹配
+        margin = int(2 / scale) + 2
+        height, width = self.img_gray.shape
+        best = None
+        for _, (cx, cy) in self._peaks(res, small_template.shape, PYRAMID_CANDIDATES, -1.0):
+            x = max(0, int(cx / scale) - margin)
+            y = max(0, int(cy / scale) - margin)
+            w = min(width - x, tw + 2 * margin)
+            h = min(height - y, th + 2 * margin)
+            if w < tw or h < th:
+                continue
+            window = self.img_gray[y: y + h, x: x + w]
+            _, score, _, (mx, my) = cv2.minMaxLoc(cv2.matchTemplate(window, template, cv2.TM_CCOEFF_NORMED))
+            if best is None or score > best[0]:
+                best = (score, (mx + x, my + y))
+        return best
+
+    def _best(self, img_gray, offset, imgfile, rect):
+        key = (templates.template_name(imgfile), rect)
+        found = self.memo.get(key)
+        if found is not None:
+            self.saved += 1
+            OpenCVImageMatcher.counters["saved"] += 1
+            return found
+
+        start_time = time.time()
+        if rect is None and self.pyramid:
+            found = self._best_pyramid(imgfile)
+        if found is None:
+            res = cv2.matchTemplate(img_gray, self.store.get(imgfile), cv2.TM_CCOEFF_NORMED)
+            _, score, _, (mx, my) = cv2.minMaxLoc(res)
+            found = (score, (mx + offset[0], my + offset[1]))
+        self.metrics.match(key, time.time() - start_time, found[0])
+        self.memo[key] = found
+        self.computed += 1
+        OpenCVImageMatcher.counters["computed"] += 1
+        return found
+
+    def match_best(self, imgfile, rect=None):
+        """最佳匹配位置及其分数: (score, (x, y))"""
+        img_gray, offset = self.crop(rect)
+        return self._best(img_gray, offset, imgfile, rect)
+
+    def match_top(self, imgfile, rect=None, k=5, threshold=0.8):
+        """分数最高的 k 个匹配: [(score, (x, y)), ...]
+
+        每取出一个峰值，就把它周围模板大小一半的邻域抹掉，避免同一目标重复计数。
+        """
+        res, (x, y) = self.match_result(imgfile, rect)
+        return [(score, (mx + x, my + y))
+                for score, (mx, my) in self._peaks(res, self.store.get(imgfile).shape, k, threshold)]
+
+    def match_many(self, items, rect=None, threshold=0.8):
+        """同一区域批量匹配多个模板, 返回按分数排序的 MatchTable
+
+        items 的元素为模板文件名, 或 (文件名, 阈值)。区域只裁剪一次。
+        """
+        img_gray, offset = self.crop(rect)
+        table = MatchTable()
+        for item in items:
+            if isinstance(item, tuple):
+                imgfile, t = item
+            else:
+                imgfile, t = item, threshold
+            score, pos = self._best(img_gray, offset, imgfile, rect)
+            self.metrics.check((templates.template_name(imgfile), rect), score >= t)
+            table.append(MatchResult(imgfile, score, pos, t))
+        table.sort(key=lambda r: r.score, reverse=True)
+        return table
 
-        locs = zip(*loc[::-1])
+    def match_sub_image(self, imgfile, threshold = 0.8):
+        return self.match_sub_image_in_rect(imgfile, None, threshold)
 
-        if locs:
-            mx, my = locs[0]
-            return mx + x, my + y
+    def match_sub_image_in_rect(self, imgfile, rect, threshold = 0.8):
+        score, pos = self.match_best(imgfile, rect)
+        self.metrics.check((templates.template_name(imgfile), rect), score >= threshold)
+        if score >= threshold:
+            return pos
         return None
 
 
     def match_sub_image_multi(self, imgfile, threshold = 0.97):
 
-        template = cv2.imread(imgfile, 0)
-        res = cv2.matchTemplate(self.img_gray, template, cv2.TM_CCOEFF_NORMED)
+        res, _ = self.match_result(imgfile)
 
         loc = np.where( res >= threshold)
 
         return [(x,y) for x, y in zip(*loc[::-1])]
 
 
+    def is_transition(self):
+        # 最左边经验条，为橘红色时，场景过渡进度条
+        if not any(self.img[y, 3, 0] > 150 for y in TRANSITION_PROBES):
+            return False
+        return not self.match_sub_image("./login_game_button.png")
+
+    def classify(self):
+        """完整模板匹配判定场景: transition / battle / normal / special"""
+        with self.metrics.stage("is_transition"):
+            if self.is_transition():
+                return "transition"
+        with self.metrics.stage("is_battle"):
+            if self.is_battle():
+                return "battle"
+        with self.metrics.stage("is_normal"):
+            if self.is_normal():
+                return "normal"
+        return "special"
+
+    def signature(self):
+        """画面签名：像素判定的结果, 加上几个固定区域的低分辨率、低位深亮度
+
+        过渡条亮起时结果还取决于全屏的登录按钮匹配, 签名覆盖不到, 返回 None 不缓存。
+        """
+        probes = self.img[TRANSITION_PROBES, 3, 0] > 150
+        if probes.any():
+            return None
+        parts = ["1" if self.is_non_special() else "0"]
+        for rect in SceneCache.SIGNATURE_RECTS:
+            cropped, _ = self.crop(rect)
+            small = cv2.resize(cropped, SceneCache.SIZE, interpolation=cv2.INTER_AREA)
+            parts.append((small >> 3).tostring())
+        return "".join(parts)
+
+    def scene(self, cache=None):
+        """带缓存的场景判定，仅在缓存未命中时做模板匹配"""
+        cache = cache if cache is not None else scene_cache
+        sig = self.signature()
+        scene = cache.get(sig) if sig is not None else None
+        if scene is None:
+            scene = self.classify()
+            if sig is not None:
+                cache.put(sig, scene)
+        if self.trace is not None:
+            self.trace["scene"] = scene
+        return scene
+
     def is_non_special(self):
         # right corner,
         return self.img[2024, 1530, 0] > 200 and self.img[2024, 1530, 1] > 200 and self.img[2024, 1530, 2] > 200
@@ -197,6 +478,67 @@ class OpenCVImageMatcher(object):
 
 
 
+class SceneCache(object):
+    """画面签名 -> 场景分类的 LRU 缓存"""
+
+    SCENES = ("battle", "normal", "special", "transition")
+    # 参与签名的区域，覆盖 is_battle / is_normal 用到的图标位置
+    SIGNATURE_RECTS = (RECTS.BottomIcons, RECTS.TopIcons, RECTS.LeftIcons,
+                       RECTS.BattleTopRightCorner, RECTS.BattleHeading, RECTS.YaBiaoRemainTime)
+    # 每个区域缩放到的大小 (w, h)
+    SIZE = (16, 16)
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._cache = collections.OrderedDict()
+        # conf.analysis = "thread" 时多个设备的分析线程共用
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, sig):
+        with self._lock:
+            scene = self._cache.pop(sig, None)
+            if scene is None:
+                self.misses += 1
+                return None
+            self._cache[sig] = scene
+            self.hits += 1
+            return scene
+
+    def put(self, sig, scene):
+        with self._lock:
+            self._cache.pop(sig, None)
+            self._cache[sig] = scene
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+    def seed(self, directory):
+        """从标注好的截图目录预热: directory/<scene>/*.png"""
+        count = 0
+        for scene in self.SCENES:
+            for path in sorted(glob.glob(os.path.join(directory, scene, "*.png"))):
+                matcher = OpenCVImageMatcher(Image.open(path).convert("RGB"))
+                sig = matcher.signature()
+                if sig is not None:
+                    self.put(sig, scene)
+                    count += 1
+        return count
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def stats(self):
+        return dict(size=len(self._cache), hits=self.hits, misses=self.misses,
+                    hit_rate=self.hit_rate)
+
+
+scene_cache = SceneCache()
+
+
 def find_who_is_need_feed(positions):
     need_feed = []
     for x, y in positions:
@@ -218,10 +560,247 @@ def find_who_is_need_feed(positions):
     else:
         return []
 
+class ActionSequence(object):
+    """命名的动作序列, 交给 game.schedule() 后由 ActionScheduler 用定时器逐步执行
+
+    guard(matcher) 在序列执行期间对每个新帧检查, 返回 False 时取消剩余动作。
+    """
+    # 拖动时相邻两次 mouseMove 的间隔(秒), 与 vncdotool mouseDrag 的节奏相同
+    DRAG_INTERVAL = 0.2
+    def __init__(self, name, guard=None):
+        self.name = name
+        self.guard = guard
+        # (client 方法名, args, kwargs), 方法名 "wait" 表示等待
+        self.steps = []
+
+    def __len__(self):
+        return len(self.steps)
+
+    def _add(self, name, *args, **kwargs):
+        self.steps.append((name, args, kwargs))
+        return self
+
+    def tap(self, x, y):
+        return self._add("touchAt", x, y)
+
+    def wait(self, seconds):
+        return self._add("wait", seconds)
+
+    def key(self, key):
+        return self._add("keyPress", key)
+
+    def key_event(self, key, down):
+        return self._add("keyEvent", key, down=down)
+
+    def drag(self, x0, y0, x1, y1, step=1):
+        """按下 (x0, y0), 先纵向再横向每 step 像素移动一次, 在 (x1, y1) 抬起
+
+        不用 vncdotool 的 mouseDrag: 它每一步 time.sleep, 会阻塞 reactor。
+        """
+        self._add("mouseMove", x0, y0)
+        self._add("mouseDown", 1)
+        points = [(x0, y) for y in range(y0, y1, step if y1 > y0 else -step)[1:]]
+        points += [(x, y1) for x in range(x0, x1, step if x1 > x0 else -step)]
+        points.append((x1, y1))
+        for x, y in points:
+            self.wait(self.DRAG_INTERVAL)
+            self._add("mouseMove", x, y)
+        return self._add("mouseUp", 1)
+
+
+def not_in_battle(matcher):
+    return matcher.scene() != "battle"
+
+
+# 规则表中 "guard" 可用的检查
+SEQUENCE_GUARDS = dict(not_in_battle=not_in_battle)
+
+
+# 规则表中 "handler" 引用的函数: name -> func(game, matcher, pos), 返回 STOP_AFTER 或 None
+RULE_HANDLERS = dict()
+
+
+def rule_handler(name):
+    def register(func):
+        RULE_HANDLERS[name] = func
+        return func
+    return register
+
+
+class Rule(object):
+    """规则表中的一条规则: 模板在 rect 中命中时执行的动作
+
+    actions 的每一步:
+      ["tap"]              点击命中位置
+      ["tap", x, y, n]     点击绝对坐标, x/y 为 null 时取命中位置, n 为次数(可省略)
+      ["tap_rel", dx, dy]  点击命中位置加偏移
+      ["pause", seconds]   等待, 含等待的动作序列交给 game.schedule() 执行
+    "guard" 为 SEQUENCE_GUARDS 中的名字, 序列执行期间画面不再满足时取消
+    """
+    def __init__(self, scene, data):
+        self.scene = scene
+        self.name = data["name"]
+        self.priority = data.get("priority", 0)
+        self.template = data["template"]
+        self.rect_name = data.get("rect")
+        self.rect = getattr(RECTS, self.rect_name) if self.rect_name else None
+        self.threshold = data.get("threshold", 0.8)
+        say = data.get("say", [])
+        self.say = [say] if isinstance(say, basestring) else say
+        self.handler = data.get("handler")
+        if self.handler and self.handler not in RULE_HANDLERS:
+            raise ValueError("rule %s: unknown handler %s" % (self.name, self.handler))
+        self.actions = data.get("actions", [] if self.handler else [["tap"]])
+        self.stop_after = data.get("stop_after")
+        self.unless_status = data.get("unless_status")
+        self.set_status = data.get("set_status", {})
+        self.watch = [getattr(RECTS, name) for name in data.get("watch", [])]
+        self.guard = SEQUENCE_GUARDS[data["guard"]] if data.get("guard") else None
+
+        self.evaluations = 0
+        self.hits = 0
+        self.cost = 0.0
+
+    def enabled(self, game):
+        return not (self.unless_status and game.status.get(self.unless_status, False))
+
+    def steps(self, pos):
+        for step in self.actions:
+            op, args = step[0], step[1:]
+            if op == "tap":
+                x = args[0] if args and args[0] is not None else pos[0]
+                y = args[1] if len(args) > 1 and args[1] is not None else pos[1]
+                for _ in range(args[2] if len(args) > 2 else 1):
+                    yield "tap", (x, y)
+            elif op == "tap_rel":
+                yield "tap", (pos[0] + args[0], pos[1] + args[1])
+            elif op == "pause":
+                yield "wait", (args[0],)
+            else:
+                raise ValueError("rule %s: unknown action %s" % (self.name, op))
+
+    def fire(self, game, matcher, pos):
+        """执行动作, 返回 STOP_AFTER"""
+        for line in self.say:
+            print line
+        steps = list(self.steps(pos))
+        if any(name == "wait" for name, _ in steps):
+            sequence = ActionSequence(self.name, self.guard)
+            for name, args in steps:
+                getattr(sequence, name)(*args)
+            game.schedule(sequence)
+        else:
+            for _, args in steps:
+                game.touchAt(*args)
+        game.status.update(self.set_status)
+        if self.watch:
+            game.watch(*self.watch)
+
+        stop_after = self.stop_after
+        if self.handler:
+            result = RULE_HANDLERS[self.handler](game, matcher, pos)
+            if result is not None:
+                stop_after = result
+        return stop_after
+
+
+class RuleEngine(object):
+    """按场景组织的规则表, 从 JSON 加载: {scene: [rule, ...]}
+
+    规则按 priority 从小到大检查。同一 rect 的规则在第一次用到时作为一组,
+    用 match_many 一次匹配; 第一条命中的规则执行后停止, 后面的 rect 不再匹配。
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.tables = dict()
+        # conf.analysis = "thread" 时多个分析线程同时更新统计
+        self._lock = threading.Lock()
+        if path:
+            self.load(path)
+
+    def load(self, path):
+        with open(path) as fp:
+            data = json.load(fp)
+        tables = dict()
+        for scene, items in data.items():
+            tables[scene] = sorted((Rule(scene, item) for item in items),
+                                   key=lambda rule: rule.priority)
+        self.tables = tables
+        self.path = path
+        return sum(len(rules) for rules in tables.values())
+
+    def run(self, scene, matcher, game):
+        """返回 (命中的规则, STOP_AFTER), 都未命中时为 (None, None)"""
+        rules = [rule for rule in self.tables.get(scene, ()) if rule.enabled(game)]
+        trace = matcher.trace
+        groups = dict()
+        for rule in rules:
+            table = groups.get(rule.rect)
+            if table is None:
+                group = [r for r in rules if r.rect == rule.rect]
+                start_time = time.time()
+                table = groups[rule.rect] = matcher.match_many(
+                    [(r.template, r.threshold) for r in group], rule.rect)
+                cost = (time.time() - start_time) / len(group)
+                with self._lock:
+                    for r in group:
+                        r.evaluations += 1
+                        r.cost += cost
+            else:
+                cost = 0.0
+
+            result = table.get(rule.template)
+            if trace is not None:
+                trace["rules"].append((rule.name, result.score, cost))
+            if result.score >= rule.threshold:
+                with self._lock:
+                    rule.hits += 1
+                if trace is not None:
+                    trace["rule"] = rule.name
+                return rule, rule.fire(game, matcher, result.pos)
+        return None, None
+
+    def stats(self):
+        """每条规则的匹配次数、命中次数、累计耗时, 按耗时从高到低"""
+        with self._lock:
+            result = [dict(scene=rule.scene, name=rule.name, evaluations=rule.evaluations,
+                           hits=rule.hits, cost=rule.cost)
+                      for rules in self.tables.values() for rule in rules]
+        result.sort(key=lambda item: item["cost"], reverse=True)
+        return result
+
+    def report(self, limit=10):
+        for item in self.stats()[:limit]:
+            if item["evaluations"]:
+                log.info("rule %(scene)s/%(name)s: %(evaluations)d evals, %(hits)d hits, "
+                         "%(cost).3fs", item)
+
+
+# BaseGameLogic.loop / is_battle / is_normal 用到的模板
+SCENE_TEMPLATES = (
+    "login_game_button.png",
+    "chat_input.png",
+    "yabiao_remain_time_label.png",
+    "in_battle_dropdown_button.png",
+    "battle_cancel_icon.png",
+    "tactical_formation_icon.png",
+    "auto_icon.png",
+    "guide_icon.png",
+    "mall_icon.png",
+    "plus_icon.png",
+)
+
+
 class BaseGameLogic(object):
-    def __init__(self):
+    # 需要加载的模板，见 templates.match_patterns
+    TEMPLATES = ("*.png",)
+    # 跨帧保存的属性; conf.analysis = "thread" 时在副本上决策, 结果被采用才写回
+    STATE = ()
+
+    def __init__(self, store=None):
         self.game = None
         self.matcher = None
+        self.store = store or templates.store
 
         self.switch_to = None
         self.STOP_AFTER = 0.5
@@ -230,31 +809,47 @@ class BaseGameLogic(object):
 
     def loop(self, game):
         self.game = game
-        self.matcher = matcher = OpenCVImageMatcher(game.screen)
+        self.matcher = matcher = game.create_matcher(self.store)
 
-        if not matcher.match_sub_image("./login_game_button.png"):
-            for y in [40, 80, 536, 939, 1254, 1733, 1908, 2034]:
-                r, g, b = game.screen.getpixel((3,y))
-                if r > 150:
-                    print u"场景过渡： skip"
-                    return 0
+        scene = matcher.scene()
+        if scene == "transition":
+            print u"场景过渡： skip"
+            return 0
 
         if matcher.match_sub_image("./chat_input.png"):
             print u"检测到聊天窗口开启 -- 停止挂机"
             return self.STOP_AFTER
 
-        if matcher.is_battle():
+        name = type(self).__name__
+        if scene == "battle":
             print u"# 战斗模式"
-            self.handle_battle()
-        elif matcher.is_normal():
+            with matcher.metrics.stage(name + ".handle_battle"):
+                self.handle_battle()
+        elif scene == "normal":
             print u"# 场景模式"
-            self.handle_normal()
+            with matcher.metrics.stage(name + ".handle_normal"):
+                self.handle_normal()
         else:
             print u"# 特殊模式"
-            self.handle_special()
+            with matcher.metrics.stage(name + ".handle_special"):
+                self.handle_special()
 
+        regions = self.regions()
+        if regions:
+            game.watch(*regions)
         return self.STOP_AFTER
 
+    def regions(self):
+        """当前状态下需要刷新的 RECTS, None 为全屏"""
+        return None
+
+    def get_state(self):
+        return dict((name, copy.deepcopy(getattr(self, name))) for name in self.STATE)
+
+    def set_state(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
 
     def handle_battle(self):
         pass
@@ -265,116 +860,135 @@ class BaseGameLogic(object):
     def handle_special(self):
         pass
 
+class QuestionBank(object):
+    """三界奇缘题库: 题目图片 -> 答案图片列表, 从 JSON 加载
+
+    所有题目模板在题目区域上一次批量匹配, 取分数最高的一个。
+    题目区域的低分辨率签名 -> 题目 的结果会被记住, 同一道题之后的帧不必再匹配。
+    """
+    # 签名: 题目区域缩小到 (w, h), 亮度取高 4 位
+    SIZE = (10, 105)
+
+    def __init__(self, path, rect=RECTS.SanJieQiYuanQuestion, unknown_dir=None, maxsize=256):
+        self.rect = rect
+        self.unknown_dir = unknown_dir
+        self.maxsize = maxsize
+        # 签名 -> 题目, 未知题目为 None
+        self._memo = dict()
+
+        root = os.path.dirname(path)
+        with open(path) as fp:
+            self.questions = json.load(fp)
+        for question in self.questions:
+            question["question"] = os.path.join(root, question["question"])
+            question["answers"] = [os.path.join(root, answer) for answer in question["answers"]]
+            question.setdefault("threshold", 0.8)
+        self._by_template = dict((templates.template_name(q["question"]), q) for q in self.questions)
+
+    def signature(self, matcher):
+        cropped, _ = matcher.crop(self.rect)
+        return (cv2.resize(cropped, self.SIZE, interpolation=cv2.INTER_AREA) >> 4).tostring()
+
+    def classify(self, matcher):
+        """返回 (题目, 是否命中签名缓存); 不在题库中时题目为 None"""
+        sig = self.signature(matcher)
+        if sig in self._memo:
+            return self._memo[sig], True
+
+        table = matcher.match_many([(q["question"], q["threshold"]) for q in self.questions], self.rect)
+        hits = table.hits()
+        question = self._by_template[templates.template_name(hits[0].imgfile)] if hits else None
+        if question is None:
+            self.save_unknown(matcher)
+
+        if len(self._memo) >= self.maxsize:
+            self._memo.clear()
+        self._memo[sig] = question
+        return question, False
+
+    def save_unknown(self, matcher):
+        """保存未知题目的截图, 供标注后加入题库"""
+        if not self.unknown_dir:
+            return None
+        if not os.path.isdir(self.unknown_dir):
+            os.makedirs(self.unknown_dir)
+        x, y, w, h = self.rect
+        path = os.path.join(self.unknown_dir, "%s.png" % time.strftime("%Y%m%d-%H%M%S"))
+        Image.fromarray(matcher.img[y: y + h, x: x + w]).save(path)
+        print u"未知题目截图已保存:", path
+        return path
+
+
+# 三界奇缘题库
+QUESTIONS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sanjieqiyuan", "questions.json")
+
+
 class SanJieQiYuanGameLogic(BaseGameLogic):
+    TEMPLATES = SCENE_TEMPLATES + ("sanjieqiyuan_window_title.png", "sanjieqiyuan/*.png")
+    # 同一题多个答案之间的点击间隔(秒)
+    ANSWER_TAP_INTERVAL = 0.5
+    STATE = ("in_quiz",)
 
-    def find_answer_pic_and_click(self, pic):
-        pos = self.matcher.match_sub_image_in_rect(pic, RECTS.SanJieQiYuanAnswer)
-        if pos:
-            self.game.touchAt(*pos)
-            return True
-        else:
-            return False
+    def __init__(self, store=None):
+        super(SanJieQiYuanGameLogic, self).__init__(store)
+
+        self.in_quiz = False
+        self.bank = QuestionBank(QUESTIONS_FILE,
+                                 unknown_dir=getattr(conf, "sanjieqiyuan_unknown_dir", None))
+
+    def regions(self):
+        if self.in_quiz:
+            return [RECTS.WindowTitle, RECTS.SanJieQiYuanQuestion, RECTS.SanJieQiYuanAnswer]
+        return None
+
+    def click_answers(self, question):
+        """一次扫描答案区域的所有候选头像, 把命中的全部排进同一个点击序列"""
+        game = self.game
+        table = self.matcher.match_many(question["answers"], RECTS.SanJieQiYuanAnswer)
+        for result in table:
+            print "  %-40s score=%.3f%s" % (templates.template_name(result.imgfile), result.score,
+                                           " *" if result.hit else "")
+        hits = table.hits()
+        if not hits:
+            print u"未找到答案头像"
+            return 0
+
+        sequence = ActionSequence(u"三界奇缘答题")
+        for i, result in enumerate(hits):
+            if i:
+                sequence.wait(self.ANSWER_TAP_INTERVAL)
+            sequence.tap(*result.pos)
+        game.schedule(sequence)
+        return len(hits)
 
     def handle_special(self):
         matcher = self.matcher
-        if not self.matcher.match_sub_image_in_rect("./sanjieqiyuan_window_title.png", RECTS.WindowTitle):
+        self.in_quiz = bool(matcher.match_sub_image_in_rect("./sanjieqiyuan_window_title.png", RECTS.WindowTitle))
+        if not self.in_quiz:
             return None
 
         print u"三界奇缘答题"
-        if matcher.match_sub_image_in_rect("./sanjieqiyuan/tian_ming_qu_jing_ren.png", RECTS.SanJieQiYuanQuestion):
-            print u"寻找3个天命取经人"
-            self.find_answer_pic_and_click("./sanjieqiyuan/tang_seng.png") or \
-                self.find_answer_pic_and_click("./sanjieqiyuan/sun_wu_kong.png") or \
-                self.find_answer_pic_and_click("./sanjieqiyuan/zhu_ba_jie.png")
-        elif matcher.match_sub_image_in_rect("./sanjieqiyuan/da_nao_tian_gong.png", RECTS.SanJieQiYuanQuestion):
-            print u"谁曾经大闹天宫"
-            self.find_answer_pic_and_click("./sanjieqiyuan/sun_wu_kong.png")
-        elif matcher.match_sub_image_in_rect("./sanjieqiyuan/sun_wu_kong_shi_fu.png", RECTS.SanJieQiYuanQuestion):
-            print u"找出2个孙悟空的师傅"
-            self.find_answer_pic_and_click("./sanjieqiyuan/tang_seng.png") or \
-                self.find_answer_pic_and_click("./sanjieqiyuan/pu_ti_lao_zu.png")
-
-        elif matcher.match_sub_image_in_rect("./sanjieqiyuan/nv_xing_ke_xuan_jue_se.png", RECTS.SanJieQiYuanQuestion):
-            print u"找出3个女性可选角色"
-            self.find_answer_pic_and_click("./sanjieqiyuan/wu_man_er.png") or \
-                self.find_answer_pic_and_click("./sanjieqiyuan/xuan_cai_e.png") or \
-                self.find_answer_pic_and_click("./sanjieqiyuan/gu_jing_ling.png")
-
-        elif matcher.match_sub_image_in_rect("./sanjieqiyuan/niu_mo_wang_yi_jia.png", RECTS.SanJieQiYuanQuestion):
-            print u"找出牛魔王一家人"
-            self.find_answer_pic_and_click("./sanjieqiyuan/niu_mo_wang.png") or \
-                self.find_answer_pic_and_click("./sanjieqiyuan/tie_shan_gong_zhu.png") or \
-                self.find_answer_pic_and_click("./sanjieqiyuan/hong_hai_er.png")
-
-        elif matcher.match_sub_image_in_rect("./sanjieqiyuan/xian_zu_zhu_jue.png", RECTS.SanJieQiYuanQuestion):
-            print u"找出2个仙族主角"
-            self.find_answer_pic_and_click("./sanjieqiyuan/long_tai_zi.png") or \
-                self.find_answer_pic_and_click("./sanjieqiyuan/xuan_cai_e.png")
-
-        elif matcher.match_sub_image_in_rect("./sanjieqiyuan/shi_tuo_ling_san_xiong_di.png", RECTS.SanJieQiYuanQuestion):
-            print u"找出狮驼岭三兄弟"
-            self.find_answer_pic_and_click("./sanjieqiyuan/da_da_wang.png") or \
-                self.find_answer_pic_and_click("./sanjieqiyuan/er_da_wang.png") or \
-                self.find_answer_pic_and_click("./sanjieqiyuan/san_da_wang.png")
-
-        elif matcher.match_sub_image_in_rect("./sanjieqiyuan/ping_ding_shan_yao_guai.png", RECTS.SanJieQiYuanQuestion):
-            print u"找出2个平顶山的妖怪"
-            self.find_answer_pic_and_click("./sanjieqiyuan/jin_jiao_da_wang.png") or \
-                self.find_answer_pic_and_click("./sanjieqiyuan/yin_jiao_da_wang.png")
-
-        elif matcher.match_sub_image_in_rect("./sanjieqiyuan/jin_chan_zi_zhuan_shi.png", RECTS.SanJieQiYuanQuestion):
-            print u"金蝉子转世"
-            self.find_answer_pic_and_click("./sanjieqiyuan/tang_seng.png")
-
-        elif matcher.match_sub_image_in_rect("./sanjieqiyuan/jing_jing_gu_niang_xi_huan.png", RECTS.SanJieQiYuanQuestion):
-            print u"晶晶姑娘喜欢的人"
-            self.find_answer_pic_and_click("./sanjieqiyuan/sun_wu_kong.png")
-
-        elif matcher.match_sub_image_in_rect("./sanjieqiyuan/gu_jing_ling_shi_fu.png", RECTS.SanJieQiYuanQuestion, threshold = 0.9):
-            print u"骨精灵的师傅"
-            self.find_answer_pic_and_click("./sanjieqiyuan/da_da_wang.png") or \
-                self.find_answer_pic_and_click("./sanjieqiyuan/di_zang_wang.png")
-
-        elif matcher.match_sub_image_in_rect("./sanjieqiyuan/shi_tuo_guo_guo_wang.png", RECTS.SanJieQiYuanQuestion):
-            print u"狮驼国国王"
-            self.find_answer_pic_and_click("./sanjieqiyuan/san_da_wang.png")
-
-        elif matcher.match_sub_image_in_rect("./sanjieqiyuan/kui_mu_lang_ai_ren.png", RECTS.SanJieQiYuanQuestion):
-            print u"奎木狼爱人"
-            self.find_answer_pic_and_click("./sanjieqiyuan/bai_hua_xiu.png")
-
-        elif matcher.match_sub_image_in_rect("./sanjieqiyuan/long_tai_zi_shi_fu.png", RECTS.SanJieQiYuanQuestion, threshold = 0.9):
-            print u"龙太子的师傅"
-            self.find_answer_pic_and_click("./sanjieqiyuan/dong_hai_long_wang.png") or \
-                self.find_answer_pic_and_click("./sanjieqiyuan/guan_yin.png")
-
-        elif matcher.match_sub_image_in_rect("./sanjieqiyuan/san_ge_gu_gei_le_shei.png", RECTS.SanJieQiYuanQuestion):
-            print u"3个箍给了谁"
-            self.find_answer_pic_and_click("./sanjieqiyuan/sun_wu_kong.png") or \
-                self.find_answer_pic_and_click("./sanjieqiyuan/hong_hai_er.png") or \
-                self.find_answer_pic_and_click("./sanjieqiyuan/hei_xiong_jing.png")
-
-        elif matcher.match_sub_image_in_rect("./sanjieqiyuan/yao_chi_zhen_shou.png", RECTS.SanJieQiYuanQuestion):
-            print u"瑶池珍兽"
-            self.find_answer_pic_and_click("./sanjieqiyuan/fu_rong_xian_zi.png") or \
-                self.find_answer_pic_and_click("./sanjieqiyuan/wu_zhong_xian.png") or \
-                self.find_answer_pic_and_click("./sanjieqiyuan/hou_xiao_xian.png")
-
-        elif matcher.match_sub_image_in_rect("./sanjieqiyuan/huo_li_da_gong_zhuan_qian.png", RECTS.SanJieQiYuanQuestion):
-            print u"消耗活力打工赚钱"
-            self.find_answer_pic_and_click("./sanjieqiyuan/yan_ru_yu.png")
-
-        elif matcher.match_sub_image_in_rect("./sanjieqiyuan/san_jie_qi_yuan_finished_label.png", (563, 1011, 147, 603)):
+        # 先排除答题结束画面, 以免被当作未知题目保存
+        if matcher.match_sub_image_in_rect("./sanjieqiyuan/san_jie_qi_yuan_finished_label.png", (563, 1011, 147, 603)):
             print u"领取奖励"
             self.game.touchAt(716, 422)
             self.game.touchAt(1319, 1923)
-        else:
+            return None
+
+        question, _ = self.bank.classify(matcher)
+        if question is None:
             print u"不在题库，请手工作答"
+            return None
+
+        print question["title"]
+        self.click_answers(question)
 
 
 class ZhuoGuiGameLogic(BaseGameLogic):
-    def __init__(self):
-        super(ZhuoGuiGameLogic, self).__init__()
+    STATE = ("nothing_to_do_counter",)
+
+    def __init__(self, store=None):
+        super(ZhuoGuiGameLogic, self).__init__(store)
 
         self.nothing_to_do_counter = 0
 
@@ -429,13 +1043,8 @@ class ZhuoGuiGameLogic(BaseGameLogic):
                 print u"连续%d尝试失败，尝试打开活动窗口领任务！" % game.nothing_to_do_counter
                 game.screen.save("./2.png")
 
-                d = defer.Deferred()
-                d.addCallback(lambda _, *args: game.touchAt(*args), 1454, 700)
-                d.addCallback(lambda _, *args: game.pause(*args), 0.5)
                 print u"切换到日常活动标签"
-                d.addCallback(lambda _, *args: game.touchAt(*args), 1194, 351)
-
-                game.deferred = d
+                game.schedule(ActionSequence(u"打开活动窗口").tap(1454, 700).wait(0.5).tap(1194, 351))
                 return 1.0
             else:
                 self.nothing_to_do_counter += 1
@@ -485,10 +1094,7 @@ class ZhuoGuiGameLogic(BaseGameLogic):
                         break
 
                     print u"未找到捉鬼任务，尝试滑动下一页..."
-                    game.mouseMove(810, 1685)
-                    game.mouseDown(1)
-                    game.mouseDrag(810, 900, step = 20)
-                    game.mouseUp(1)
+                    game.schedule(ActionSequence(u"活动列表翻页").drag(810, 1685, 810, 900, step=20))
                     break
             break
 
@@ -500,15 +1106,16 @@ class ZhuoGuiGameLogic(BaseGameLogic):
 
 class RoutineWorkGameLogic(BaseGameLogic):
     """日常任务逻辑"""
-    def __init__(self):
-        super(RoutineWorkGameLogic, self).__init__()
+    STATE = ("nothing_to_do_counter",)
+
+    def __init__(self, store=None):
+        super(RoutineWorkGameLogic, self).__init__(store)
 
         self.nothing_to_do_counter = 0
-        self.ping_ding_an_bang = False
 
 
     def handle_battle(self):
-        mathcer = self.matcher
+        matcher = self.matcher
         game = self.game
         if matcher.match_sub_image_in_rect("./fashu_icon.png", RECTS.RightIcons):
             print u"已设置自动战斗！"
@@ -519,143 +1126,123 @@ class RoutineWorkGameLogic(BaseGameLogic):
             game.touchAt(pos[0] + 20, pos[1] + 20)
 
     def handle_normal(self):
-        mathcer = self.matcher
-        game = self.game
-        while True:
-            if not self.ping_ding_an_bang:
-                # 右上角有小红点，所以要严格匹配
-                pos = matcher.match_sub_image_in_rect("./guaji_notify_icon.png", RECTS.TopIcons, threshold = 0.9)
-                if pos:
-                    print u"挂机图标：领取平定安邦任务"
-                    d = defer.Deferred()
-                    d.addCallback(lambda _, *arg: game.touchAt(*arg), *pos)
-                    d.addCallback(lambda _, *arg: game.pause(*arg), 2.0)
-                    # 平定安邦
-                    d.addCallback(lambda _, *arg: game.touchAt(*arg), 267, 274)
-                    game.deferred = d
-                    STOP_AFTER = 5.0
-                    game.status['ping_ding_an_bang'] = True
-                    break
+        handle_normal_scene(self.game, self.matcher)
 
-            pos = matcher.match_sub_image_in_rect("./bangpai_task.png", RECTS.Actions)
-            if pos:
-                print u"处理帮派任务按钮", pos
-                game.touchAt(*pos)
-                break
 
-            pos = matcher.match_sub_image_in_rect("./qiecuo_icon.png", RECTS.Actions)
-            if pos:
-                print u"处理帮派任务--切磋"
-                game.touchAt(*pos)
-                break
+@rule_handler("use_item")
+def use_item(game, matcher, pos):
+    print u"处理任务道具使用", pos
+    game.touchAt(*pos)
+    if matcher.match_sub_image_in_rect("./cangbaotu_icon.png", RECTS.ItemUse):
+        print u"藏宝图使用"
+        return 10.0
+    return 3.0
 
-            # 这里的领取宝图任务可能和领取别的任务的描述相似度过高，所以取 t=0.9
-            pos = matcher.match_sub_image_in_rect("./lingqu_baotu_button.png", RECTS.Actions, threshold=0.9) or \
-                  matcher.match_sub_image_in_rect("./lingqu_baotu_tingtingwufang_button.png", RECTS.Actions)
-            if pos:
-                print u"领取宝图任务"
-                print u"重置藏宝图状态"
-                game.status['cang_bao_tu'] = False
-                game.touchAt(*pos)
-                break
 
-            pos = matcher.match_sub_image_in_rect("./get_bangpai_task_button.png", RECTS.Actions)
-            if pos:
-                print u"领取帮派任务"
-                game.touchAt(*pos)
-                break
+@rule_handler("buy_pet")
+def buy_pet(game, matcher, pos):
+    pos = matcher.match_sub_image("./buy_button.png")
+    if pos:
+        game.touchAt(*pos)
 
-            pos = matcher.match_sub_image_in_rect("./yasong_putong_biaoyin_button.png", RECTS.Actions)
-            if pos:
-                print u"领取普通运镖任务"
-                game.touchAt(*pos)
-                break
 
-            pos = matcher.match_sub_image_in_rect("./shimen_extra_task_button.png", RECTS.Actions)
-            if pos:
-                print u"特殊师门任务按钮"
-                game.touchAt(*pos)
-                break
+@rule_handler("announcement")
+def close_announcement(game, matcher, pos):
+    pos = matcher.match_sub_image("./ok_button.png")
+    if pos:
+        game.touchAt(pos[0] + 40, pos[1] + 40)
 
-            # 只有一个NPC上有多个任务时候才会出现
-            pos = matcher.match_sub_image_in_rect("./shimenrenwu_button.png", RECTS.Actions)
-            if pos:
-                print u"师门任务按钮"
-                game.touchAt(*pos)
-                break
 
-            pos = matcher.match_sub_image_in_rect("./use_icon.png", RECTS.ItemUse)
-            if pos:
-                print u"处理任务道具使用", pos
-                game.touchAt(*pos)
-                STOP_AFTER = 3.0
-                break
+@rule_handler("package")
+def find_cangbaotu(game, matcher, pos):
+    pos = matcher.match_sub_image_in_rect("./cangbaotu_icon.png", RECTS.MyPackage)
+    if pos:
+        print u"发现藏宝图"
+        game.touchAt(*pos)
+        print u"使用"
+        game.touchAt(608, 788)
+        return 10.0
+    print u"未找到藏宝图，藏宝图标记完成"
+    game.status['cang_bao_tu'] = True
 
 
-            # $$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$
-            pt = None
+@rule_handler("activity")
+def take_activity_task(game, matcher, pos):
+    # 活跃度奖励
+    if matcher.match_sub_image("./activity_info_popup_label.png"):
+        print u"BUG: 任务详情页被打开，关闭活动窗口"
+        game.touchAt(1321, 1872)
+        game.touchAt(1321, 1872)
+        return None
 
-            def match_and_click(pic, description):
-                # use RECT match
-                pos = matcher.match_sub_image_in_rect(pic, RECTS.Tasks)
-                if pos:
-                    print u"任务：" + description
-                    #pt = pos[0], pos[1] + 150
-                    pt = pos[0], 2000 # 尽量点击边界，免得误伤
-                    game.pause(0.5)
-                    game.touchAt(*pt)
-                    game.pause(0.2)
-                    game.touchAt(*pt)
-                    game.pause(0.2)
-                    return True
-                return False
-
-            if match_and_click("./xuanwu_label.png", u"帮派玄武任务"):
-                pass
-            elif match_and_click("./qinglong_label.png", u"帮派青龙任务"):
-                pass
-            elif match_and_click("./zhuque_label.png", u"帮派朱雀任务"):
-                pass
-            elif match_and_click("./shimen_label.png", u"师门"):
-                pass
-            elif match_and_click("./baotu_label.png", u"藏宝图"):
-                pass
-            # FIXME: 红尘试炼需要多种按钮格式配合 无法处理
-            # elif match_and_click("./hongchenshilian_label.png", "红尘试炼"):
-            #     pass
-            #elif matcher.match_sub_image_in_rect("./team_icon.png", RECTS.RightTabs):
-            elif matcher.match_sub_image_in_rect("./team_tab_label.png", RECTS.RightTeam) or \
-                 matcher.match_sub_image_in_rect("./team_tab_blood_magic.png", RECTS.RightTeam):
-                print u"检测到活动标签为队伍，尝试切换为任务标签"
-                game.touchAt(1290, 1732)
+    pos = matcher.match_sub_image_in_rect("./activity_bangpai_label.png", RECTS.ActivityPanelHeader)
+    # 判断是否帮派任务已经做完
+    if pos and not matcher.match_sub_image_in_rect("./activity_finished_button.png",
+                                                   (pos[0] - 486, pos[1] - 130, 597, 450)):
+        game.touchAt(pos[0] - 420, pos[1] + 120)
+        print u"领取帮派任务！等待到达..."
+        return 5.0
 
-            elif not game.status.get("cang_bao_tu", False):
-                print u"打开包裹寻找藏宝图"
-                game.touchAt(267, 1968)
-                game.touchAt(247, 1676)
-            else:
-                if game.status.get("nothing_to_do_counter", 0) >= 2:
-                    print u"尝试打开活动窗口领任务！"
-                    game.screen.save("./2.png")
-
-                    d = defer.Deferred()
-                    d.addCallback(lambda _, *args: game.touchAt(*args), 1454, 700)
-                    d.addCallback(lambda _, *args: game.pause(*args), 0.5)
-                    print u"切换到日常活动标签"
-                    d.addCallback(lambda _, *args: game.touchAt(*args), 1194, 351)
-                    game.deferred = d
-                    return 1.0
-                else:
-                    game.status["nothing_to_do_counter"] = game.status.get("nothing_to_do_counter", 0) + 1
-                    print u"警告！未发现可用任务，重试！"
-                    return 1.0
+    pos = matcher.match_sub_image_in_rect("./activity_yunbiao_label.png", RECTS.ActivityPanelHeader)
+    if pos:
+        # 判定活跃条颜色
+        r, g, b = game.pixel(279, 1056)
+        if g > 2 * r + 2 * b and not \
+           matcher.match_sub_image_in_rect("./activity_finished_button.png",
+                                           (pos[0] - 486, pos[1] - 130, 597, 450)):
+            game.touchAt(pos[0] - 420, pos[1] + 120)
+            print u"领取运镖任务！等待到达..."
+            return 5.0
+        else:
+            print u"忽略运镖任务"
 
-            # while
-            break
-        # 重置 counter
-        game.status["nothing_to_do_counter"] = 0
+    pos = matcher.match_sub_image_in_rect("./activity_baotu_label.png", RECTS.ActivityPanelHeader)
+    if pos and not matcher.match_sub_image_in_rect("./activity_finished_button.png",
+                                                   (pos[0] - 486, pos[1] - 130, 597, 450)):
+        game.touchAt(pos[0] - 420, pos[1] + 120)
+        print u"领取宝图任务！等待到达..."
+        return 10.0
 
+    if matcher.match_sub_image_in_rect("./activity_finished_button.png", RECTS.ActivityPanelButtons):
+        game.touchAt(1321, 1872)
+        print u"翻页已达最后，无可用任务，请手动处理！！"
+        game.status['finished'] = True
+        return None
 
+    print u"未找到可用任务，尝试滑动下一页..."
+    #game.touchAt(1192, 361) # 点击日常活动按钮, 已在打开逻辑中处理
+    # 等 2 秒再开始滑动
+    game.schedule(ActionSequence(u"活动列表翻页").wait(2.0).drag(810, 1685, 810, 1200, step=40))
+    return 3.0
+
+
+# 规则表, 启动时加载; conf.rules_file 可指定其他文件
+RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rules.json")
+rules = RuleEngine(getattr(conf, "rules_file", None) or RULES_FILE)
+
+
+def handle_normal_scene(game, matcher):
+    """一般场景: 先查规则表, 都未命中时找藏宝图或打开活动窗口, 返回 STOP_AFTER"""
+    rule, stop_after = rules.run("normal", matcher, game)
+    if rule is None:
+        if not game.status.get("cang_bao_tu", False):
+            print u"打开包裹寻找藏宝图"
+            game.touchAt(267, 1968)
+            game.touchAt(247, 1676)
+        elif game.status.get("nothing_to_do_counter", 0) >= 2:
+            print u"尝试打开活动窗口领任务！"
+            game.screen.save("./2.png")
+
+            print u"切换到日常活动标签"
+            game.schedule(ActionSequence(u"打开活动窗口").tap(1454, 700).wait(0.5).tap(1194, 351))
+            return 1.0
+        else:
+            game.status["nothing_to_do_counter"] = game.status.get("nothing_to_do_counter", 0) + 1
+            print u"警告！未发现可用任务，重试！"
+            return 1.0
+    # 重置 counter
+    game.status["nothing_to_do_counter"] = 0
+    return stop_after
 
 
 # game is the Game Client
@@ -664,28 +1251,24 @@ def loop(game):
     # print '#', time.ctime()
 
     #matcher = OpenCVImageMacher("./2.png")
-    matcher = OpenCVImageMatcher(game.screen)
+    matcher = game.create_matcher()
 
     STOP_AFTER = 0.5
 
     ######################################## 过渡
     # 最左边经验条，为橘红色时，场景过渡进度条
-    if not matcher.match_sub_image("./login_game_button.png"):
-        for y in [40, 80, 536, 939, 1254, 1733, 1908, 2034]:
-            r, g, b = game.screen.getpixel((3,y))
-            # FIXME
-            if r > 150:
-                print r, g, b
-                print u"场景过渡： skip"
-                #reactor.callLater(STOP_AFTER, reactor.stop)
-                return 0
+    scene = matcher.scene()
+    if scene == "transition":
+        print u"场景过渡： skip"
+        #reactor.callLater(STOP_AFTER, reactor.stop)
+        return 0
 
     # elif matcher.match_sub_image_in_rect("./kicked_out_label.png", RECTS.AnyPopUp):
     #     print u"警告：帐号被踢出"
     #     return
     ######################################## 战斗
     # 判定自动、取消按钮，阵法图标
-    if matcher.is_battle():
+    if scene == "battle":
         print u"判定：战斗中"
         if matcher.match_sub_image_in_rect("./fashu_icon.png", RECTS.RightIcons):
             print u"已设置自动战斗！"
@@ -701,328 +1284,27 @@ def loop(game):
 
     ######################################## 一般场景
     # 判定 “指引”， 加号，商城
-    elif matcher.is_normal():
-        # 用 while 循环的 break 快速退出判断
-        while True:
-            print u"判定：一般场景"
-            if not game.status.get('ping_ding_an_bang', False):
-                pos = matcher.match_sub_image_in_rect("./guaji_notify_icon.png",
-                                                      RECTS.TopIcons,
-                                                      threshold = 0.9)
-                if pos:
-                    print u"挂机图标：领取平定安邦任务"
-                    d = defer.Deferred()
-                    d.addCallback(lambda _, *arg: game.touchAt(*arg), *pos)
-                    d.addCallback(lambda _, *arg: game.pause(*arg), 2.0)
-                    # 平定安邦
-                    d.addCallback(lambda _, *arg: game.touchAt(*arg), 267, 274)
-                    game.deferred = d
-                    STOP_AFTER = 5.0
-                    game.status['ping_ding_an_bang'] = True
-                    break
-
-            pos = matcher.match_sub_image_in_rect("./bangpai_task.png", RECTS.Actions)
-            if pos:
-                print u"处理帮派任务按钮", pos
-                game.touchAt(*pos)
-                break
-
-            pos = matcher.match_sub_image_in_rect("./qiecuo_icon.png", RECTS.Actions)
-            if pos:
-                print u"处理帮派任务--切磋"
-                game.touchAt(*pos)
-                break
-
-            # 这里的领取宝图任务可能和领取别的任务的描述相似度过高，所以取 t=0.9
-            pos = matcher.match_sub_image_in_rect("./lingqu_baotu_button.png", RECTS.Actions, threshold=0.9) or \
-                  matcher.match_sub_image_in_rect("./lingqu_baotu_tingtingwufang_button.png", RECTS.Actions)
-            if pos:
-                print u"领取宝图任务"
-                print u"重置藏宝图状态"
-                game.status['cang_bao_tu'] = False
-                game.touchAt(*pos)
-                break
-
-            pos = matcher.match_sub_image_in_rect("./get_bangpai_task_button.png", RECTS.Actions)
-            if pos:
-                print u"领取帮派任务"
-                game.touchAt(*pos)
-                break
-
-            pos = matcher.match_sub_image_in_rect("./yasong_putong_biaoyin_button.png", RECTS.Actions)
-            if pos:
-                print u"领取普通运镖任务"
-                game.touchAt(*pos)
-                break
-
-            pos = matcher.match_sub_image_in_rect("./shimen_extra_task_button.png", RECTS.Actions)
-            if pos:
-                print u"特殊师门任务按钮"
-                game.touchAt(*pos)
-                break
-
-            # 只有一个NPC上有多个任务时候才会出现
-            pos = matcher.match_sub_image_in_rect("./shimenrenwu_button.png", RECTS.Actions)
-            if pos:
-                print u"师门任务按钮"
-                game.touchAt(*pos)
-                break
-
-            pos = matcher.match_sub_image_in_rect("./use_icon.png", RECTS.ItemUse)
-            if pos:
-                print u"处理任务道具使用", pos
-                game.touchAt(*pos)
-                if matcher.match_sub_image_in_rect("./cangbaotu_icon.png", RECTS.ItemUse):
-                    STOP_AFTER = 10.0
-                    print u"藏宝图使用"
-                else:
-                    STOP_AFTER = 3.0
-                break
-
-
-            # $$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$
-            pt = None
-
-            def match_and_click(pic, description):
-                # use RECT match
-                pos = matcher.match_sub_image_in_rect(pic, RECTS.Tasks)
-                if pos:
-                    print u"任务：" + description
-                    #pt = pos[0], pos[1] + 150
-                    pt = pos[0], 2000 # 尽量点击边界，免得误伤
-                    game.pause(0.5)
-                    game.touchAt(*pt)
-                    game.pause(0.2)
-                    game.touchAt(*pt)
-                    game.pause(0.2)
-                    return True
-                return False
-
-            if match_and_click("./xuanwu_label.png", u"帮派玄武任务"):
-                pass
-            elif match_and_click("./qinglong_label.png", u"帮派青龙任务"):
-                pass
-            elif match_and_click("./zhuque_label.png", u"帮派朱雀任务"):
-                pass
-            elif match_and_click("./shimen_label.png", u"师门"):
-                pass
-            elif match_and_click("./baotu_label.png", u"藏宝图"):
-                pass
-            # FIXME: 红尘试炼需要多种按钮格式配合 无法处理
-            # elif match_and_click("./hongchenshilian_label.png", "红尘试炼"):
-            #     pass
-            #elif matcher.match_sub_image_in_rect("./team_icon.png", RECTS.RightTabs):
-            elif matcher.match_sub_image_in_rect("./team_tab_label.png", RECTS.RightTeam) or \
-                 matcher.match_sub_image_in_rect("./team_tab_blood_magic.png", RECTS.RightTeam):
-                print u"检测到活动标签为队伍，尝试切换为任务标签"
-                game.touchAt(1290, 1732)
-
-            elif not game.status.get("cang_bao_tu", False):
-                print u"打开包裹寻找藏宝图"
-                game.touchAt(267, 1968)
-                game.touchAt(247, 1676)
-            else:
-                if game.status.get("nothing_to_do_counter", 0) >= 2:
-                    print u"尝试打开活动窗口领任务！"
-                    game.screen.save("./2.png")
-
-                    d = defer.Deferred()
-                    d.addCallback(lambda _, *args: game.touchAt(*args), 1454, 700)
-                    d.addCallback(lambda _, *args: game.pause(*args), 0.5)
-                    print u"切换到日常活动标签"
-                    d.addCallback(lambda _, *args: game.touchAt(*args), 1194, 351)
-                    game.deferred = d
-                    return 1.0
-                else:
-                    game.status["nothing_to_do_counter"] = game.status.get("nothing_to_do_counter", 0) + 1
-                    print u"警告！未发现可用任务，重试！"
-                    return 1.0
-
-            # while
-            break
-        # 重置 counter
-        game.status["nothing_to_do_counter"] = 0
+    elif scene == "normal":
+        print u"判定：一般场景"
+        with matcher.metrics.stage("loop.handle_normal"):
+            stop_after = handle_normal_scene(game, matcher)
+        if stop_after is not None:
+            STOP_AFTER = stop_after
     else:
         print u"判定：特殊场景"
-        pos = matcher.match_sub_image_in_rect("./hand_in_button.png", RECTS.TaskPopUp)
-        if pos:
-            print u"弹窗：任务物品上交"
-            game.touchAt(*pos)
-        elif matcher.match_sub_image_in_rect("./shimen_finished_label.png", RECTS.CenterPopUp):
-            print u"弹窗：师门结束提示"
-            game.touchAt(640, 800)
-        elif matcher.match_sub_image_in_rect("./sanjieqiyuan_label.png", RECTS.CenterPopUp):
-            print u"弹窗：三界奇缘活动提示"
-            print u"忽略此活动"
-            game.touchAt(650, 829)
-        elif matcher.match_sub_image_in_rect("./kejuxiangshi_label.png", RECTS.CenterPopUp):
-            print u"弹窗：科举活动提示"
-            print u"忽略此活动"
-            game.touchAt(650, 829)
-
-        elif matcher.match_sub_image_in_rect("./yabiao_popup_label.png", RECTS.CenterPopUp):
-            print u"弹窗：押镖确认询问"
-            game.touchAt(667, 1218)
-
-        elif matcher.match_sub_image_in_rect("./drug_store_icon.png", RECTS.WindowTitle):
-            print u"弹窗：药店购买"
-            for i in range(14):
-                game.touchAt(*POSITION["buy_add"])
-            game.touchAt(*POSITION["buy"])
-            print u"购买 15 个完成"
-
-        elif matcher.match_sub_image_in_rect("./shanghui_label.png", RECTS.WindowTitle):
-            print u"弹窗：商会购买"
-            game.touchAt(270, 1603)
-            print u"购买完成"
-            game.pause(0.2)
-
-        elif matcher.match_sub_image_in_rect("./buy_pet_label.png", RECTS.WindowTitle):
-            print u"弹窗：宠物购买"
-            pos = matcher.match_sub_image("./buy_button.png")
-            game.touchAt(*pos)
-            game.pause(0.5)
-
-        elif matcher.match_sub_image_in_rect("./baitan_label.png", RECTS.WindowTitle):
-            print u"弹窗：任务物品摆摊购买"
-            # 第二个
-            game.touchAt(1023, 1468)
-            game.pause(0.5)
-            game.touchAt(264, 1583)
-            game.pause(0.5)
-            game.touchAt(1324, 1852)
-        elif matcher.match_sub_image_in_rect("./bingqipu_label.png", RECTS.WindowTitle):
-            print u"弹窗：任务物品兵器铺"
-            game.touchAt(363, 1658)
-
-        elif matcher.match_sub_image_in_rect("./announcement_label.png", RECTS.WindowTitle):
-            print u"弹窗：公告"
-            pos = matcher.match_sub_image("./ok_button.png")
-            if pos:
-                game.touchAt(pos[0] + 40, pos[1] + 40)
-
-        elif not game.status.get('cang_bao_tu', False) and \
-             matcher.match_sub_image_in_rect("./package_label.png", RECTS.WindowTitle):
-            print u"弹窗：包裹"
-            pos = matcher.match_sub_image_in_rect("./cangbaotu_icon.png", RECTS.MyPackage)
+        with matcher.metrics.stage("loop.handle_special"):
+            rule, stop_after = rules.run("special", matcher, game)
+        if rule is None:
+            pos = matcher.match_sub_image("./close_icon.png")
             if pos:
-                print u"发现藏宝图"
-                game.touchAt(*pos)
-                print u"使用"
-                game.touchAt(608, 788)
-                STOP_AFTER = 10.0
+                print u"检测到有窗口遮挡"
+                game.touchAt(pos[0] + 20, pos[1] + 20)
+                return 0.5
             else:
-                print u"未找到藏宝图，藏宝图标记完成"
-                game.status['cang_bao_tu'] = True
-
-        elif matcher.match_sub_image_in_rect("./lucky_draw.png", RECTS.CenterPopUp):
-            print u"弹窗：抽奖转盘"
-            game.touchAt(915, 1017)
-        elif matcher.match_sub_image_in_rect("./activity_label.png", RECTS.WindowTitle):
-            print u"弹窗：活动列表"
-            print u"尝试领取任务"
-            #game.touchAt(363, 1658)
-            #game.pause(0.5)
-            while True:
-                # 活跃度奖励
-                if matcher.match_sub_image("./activity_info_popup_label.png"):
-                    print u"BUG: 任务详情页被打开，关闭活动窗口"
-                    game.touchAt(1321, 1872)
-                    game.touchAt(1321, 1872)
-                    break
-
-                pos = matcher.match_sub_image_in_rect("./activity_bangpai_label.png", RECTS.ActivityPanelHeader)
-                # 判断是否帮派任务已经做完
-                if pos and not matcher.match_sub_image_in_rect("./activity_finished_button.png",
-                                                               (pos[0] - 486, pos[1] - 130, 597, 450)):
-                    game.touchAt(pos[0] - 420, pos[1] + 120)
-                    print u"领取帮派任务！等待到达..."
-                    STOP_AFTER = 5.0
-                    break
-
-                pos = matcher.match_sub_image_in_rect("./activity_yunbiao_label.png", RECTS.ActivityPanelHeader)
-                if pos:
-                    # 判定活跃条颜色
-                    r, g, b = game.screen.getpixel((279, 1056))
-                    if g > 2 * r + 2 * b and not \
-                       matcher.match_sub_image_in_rect("./activity_finished_button.png",
-                                                       (pos[0] - 486, pos[1] - 130, 597, 450)):
-                        game.touchAt(pos[0] - 420, pos[1] + 120)
-                        print u"领取运镖任务！等待到达..."
-                        STOP_AFTER = 5.0
-                        break
-                    else:
-
-                        print u"忽略运镖任务"
-                        pass
-                pos = matcher.match_sub_image_in_rect("./activity_baotu_label.png", RECTS.ActivityPanelHeader)
-                if pos and not matcher.match_sub_image_in_rect("./activity_finished_button.png",
-                                                               (pos[0] - 486, pos[1] - 130, 597, 450)):
-                    game.touchAt(pos[0] - 420, pos[1] + 120)
-                    print u"领取宝图任务！等待到达..."
-                    STOP_AFTER = 10.0
-                    break
-
-                if matcher.match_sub_image_in_rect("./activity_finished_button.png", RECTS.ActivityPanelButtons):
-                    game.touchAt(1321, 1872)
-                    print u"翻页已达最后，无可用任务，请手动处理！！"
-                    game.status['finished'] = True
-                else:
-                    print u"未找到可用任务，尝试滑动下一页..."
-                    #game.touchAt(1192, 361) # 点击日常活动按钮, 已在打开逻辑中处理
-                    time.sleep(2.0)
-                    # 开始滑动
-                    game.mouseMove(810, 1685)
-                    game.mouseDown(1)
-                    game.mouseDrag(810, 1200, step = 40)
-                    game.mouseUp(1)
-                    STOP_AFTER = 3.0
-
-                # pos = matcher.match_sub_image_in_rect("./activity_baotu_label.png",
-                #                                       RECTS.ActivityPanelHeader)
-                # if pos:
-                #     game.touchAt(pos[0] - 420, pos[1] + 120)
-
-                #     print u"领取宝图任务！等待到达..."
-                #     STOP_AFTER = 10.0
-                # else:
-                #     print u"未找到可用任务，尝试滑动下一页..."
-                #     game.mouseMove(810, 1685)
-                #     game.mouseDrag(785, 327, step = 10)
-
-                #     print u"！！！无可玩任务！！！"
-                break
-
-        elif matcher.match_sub_image_in_rect("./yabiao_remain_time_label.png", RECTS.YaBiaoRemainTime):
-            print u"押镖中，等待完成..."
-            STOP_AFTER = 10.0
-        elif matcher.match_sub_image("./login_game_button.png"):
-            print u"弹窗：游戏登录窗口"
-            game.touchAt(224, 1036)
-
-        elif matcher.match_sub_image_in_rect("./continue_icon.png", RECTS.RightCorner):
-            print u"剧情：检测到继续按钮"
-            game.touchAt(1427, 1983)
-            game.touchAt(1427, 1983)
-        elif matcher.match_sub_image_in_rect("./daily_checkin_label.png", RECTS.WindowTitle):
-            print u"弹窗：每日签到"
-            positions = [(1014, 555), (1015, 804), (1003, 1020), (997, 1252), (1003, 1475)]
-            for pt in positions:
-                game.touchAt(*pt)
-
-            # 关闭
-            game.touchAt(1245, 1655)
-        else:
-            while True:
-                pos = matcher.match_sub_image("./close_icon.png")
-                if pos:
-                    print u"检测到有窗口遮挡"
-                    game.touchAt(pos[0] + 20, pos[1] + 20)
-                    return 0.5
-                else:
-                    print u"尝试等待"
-                    return 1.0
-
+                print u"尝试等待"
+                return 1.0
+        elif stop_after is not None:
+            STOP_AFTER = stop_after
 
     return STOP_AFTER
 
@@ -1030,7 +1312,7 @@ def loop(game):
 # 帐号切换
 def loop_SwitchAccount(game):
     width, height = game.width, game.height
-    matcher = OpenCVImageMatcher(game.screen)
+    matcher = game.create_matcher()
 
     STOP_AFTER = 1.0
 
@@ -1043,51 +1325,51 @@ def loop_SwitchAccount(game):
     # 第三步，登录窗口，点击网易通行证按钮
     if game.status.get("switch_account_stage", 0) == 3:
         print u"登录框：选择使用其他帐号登录"
-        d = defer.Deferred()
+        sequence = ActionSequence(u"选择其他帐号登录")
         # 无关位置
-        d.addCallback(lambda _, *arg: game.touchAt(*arg), 1020, 939)
-        d.addCallback(lambda _, *arg: game.pause(*arg), 1.0)
+        sequence.tap(1020, 939).wait(1.0)
         # 网易通行证 icon 按钮
-        d.addCallback(lambda _, *arg: game.touchAt(*arg), 542, 787)
-        # game.touchAt(1020, 939)
-        # game.touchAt(542, 787)
-        game.deferred = d
+        sequence.tap(542, 787)
+        game.schedule(sequence)
 
         game.status["switch_account_stage"] = 4
         return 5.0
 
     # 第四步，帐号密码窗口
     elif game.status.get("switch_account_stage", 0) == 4:
+        # 开启 conf.account_pool 时从帐号库租用下一个帐号, 否则输入固定帐号
+        if getattr(conf, "account_pool", False):
+            account = game.leaseAccount()
+            if account is None:
+                # 没有可用帐号; thread 模式下租约要到 replay 时才在 reactor 上完成
+                return 60.0
+            email, password = account.email, account.password
+        else:
+            email, password = random.choice(["username"]) + "@163.com", "passwd"
+        print u"登录帐号", email
 
-        d = defer.Deferred()
+        sequence = ActionSequence(u"输入帐号密码")
         # 输入窗口
-        d.addCallback(lambda _, *arg: game.touchAt(*arg), 897, 895)
+        sequence.tap(897, 895)
 
         # 等待键盘弹出
-        d.addCallback(lambda _, *arg: game.pause(*arg), 1.0)
-
-        # FIXME: 循环中使用 Python 闭包错误
-        for c in random.choice(["username"]):
-            d.addCallback(lambda _, *arg: game.keyPress(*arg), c)
-            d.addCallback(lambda _, *arg: game.pause(*arg), 0.1)
-        d.addCallback(lambda *_: game.keyEvent(rfb.KEY_ShiftLeft, down=1))
-        d.addCallback(lambda _, *arg: game.keyPress(*arg), "2")
-        d.addCallback(lambda _, *arg: game.pause(*arg), 0.1)
-        d.addCallback(lambda *_: game.keyEvent(rfb.KEY_ShiftLeft, down=0))
-
-        for c in "163.com":
-            d.addCallback(lambda _, *arg: game.keyPress(*arg), c)
-            d.addCallback(lambda _, *arg: game.pause(*arg), 0.1)
+        sequence.wait(1.0)
 
+        for c in email:
+            if c == "@":
+                sequence.key_event(rfb.KEY_ShiftLeft, 1)
+                sequence.key("2").wait(0.1)
+                sequence.key_event(rfb.KEY_ShiftLeft, 0)
+            else:
+                sequence.key(c).wait(0.1)
 
-        d.addCallback(lambda *_: game.keyEvent(rfb.KEY_Tab, down=1))
-        d.addCallback(lambda *_: game.keyEvent(rfb.KEY_Tab, down=0))
+        sequence.key_event(rfb.KEY_Tab, 1)
+        sequence.key_event(rfb.KEY_Tab, 0)
 
-        for c in "passwd":
-            d.addCallback(lambda _, *arg: game.keyPress(*arg), c)
-            d.addCallback(lambda _, *arg: game.pause(*arg), 0.1)
+        for c in password:
+            sequence.key(c).wait(0.1)
 
-        game.deferred = d
+        game.schedule(sequence)
         game.status["switch_account_stage"] = 5
         return 0.1
 
@@ -1109,44 +1391,32 @@ def loop_SwitchAccount(game):
         if matcher.match_sub_image_in_rect("./login_game_button.png", (81, 573, 445, 876)) and not \
            matcher.match_sub_image_in_rect("./server_not_yet_selected_label.png", (81, 573, 445, 876)):
             print u"弹窗：游戏登录窗口"
-            game.touchAt(224, 1036)
-            game.pause(1.0)
+            game.schedule(ActionSequence(u"进入游戏").tap(224, 1036).wait(1.0))
             game.status["finished"] = True
             return 5.0
 
 
     ######################################## 过渡
     # 最左边经验条，为橘红色时，场景过渡进度条
-    if not matcher.match_sub_image("./login_game_button.png"):
-        for y in [40, 80, 536, 939, 1254, 1733, 1908, 2034]:
-            r, g, b = game.screen.getpixel((3,y))
-            # FIXME
-            if r > 150:
-                print u"场景过渡： skip"
-                return 0
+    scene = matcher.scene()
+    if scene == "transition":
+        print u"场景过渡： skip"
+        return 0
 
     # elif matcher.match_sub_image_in_rect("./kicked_out_label.png", RECTS.AnyPopUp):
     #     print u"警告：帐号被踢出"
     #     return
     ######################################## 战斗
     # 判定自动、取消按钮，阵法图标
-    if matcher.is_battle():
+    if scene == "battle":
         print u"判定：战斗中"
         return 10
 
     # 点击加号，然后系统设置，
-    elif matcher.is_normal():
+    elif scene == "normal":
         if matcher.match_sub_image_in_rect("./plus_icon.png", RECTS.BottomIcons):
-            # 点击右下角 plus icon
-            game.touchAt(103, 1966)
-
-            d = defer.Deferred()
-            # FIXME: 循环中使用 Python 闭包错误
-            d.addCallback(lambda _, *arg: game.pause(*arg), 2.0)
-            # 设置位置
-            d.addCallback(lambda _, *arg: game.touchAt(*arg), 107, 1117)
-
-            game.deferred = d
+            # 点击右下角 plus icon, 然后是设置位置
+            game.schedule(ActionSequence(u"打开设置", not_in_battle).tap(103, 1966).wait(2.0).tap(107, 1117))
 
             return 4.0
         pos = matcher.match_sub_image_in_rect("./system_icon.png", RECTS.BottomIcons)
@@ -1159,13 +1429,11 @@ def loop_SwitchAccount(game):
     else:
         if matcher.match_sub_image_in_rect("./basic_config_label.png", (1169, 814, 143, 368)):
             print u"窗口：基础设置"
-            game.touchAt(380, 725) # 切换帐号
-            d = defer.Deferred()
-            d.addCallback(lambda _, *arg: game.pause(*arg), 1.0)
+            sequence = ActionSequence(u"登出", not_in_battle)
+            sequence.tap(380, 725) # 切换帐号
             # 确定登出
-            d.addCallback(lambda _, *arg: game.touchAt(*arg), 672, 1218)
-            d.addCallback(lambda _, *arg: game.pause(*arg), 3.0)
-            game.deferred = d
+            sequence.wait(1.0).tap(672, 1218).wait(3.0)
+            game.schedule(sequence)
 
             game.status["switch_account_stage"] = 3 # 帐号信息窗口
             return 4.0
@@ -1185,8 +1453,7 @@ class JuQingGameLogic(BaseGameLogic):
         game = self.game
         if matcher.match_sub_image_in_rect("./fashu_icon.png", RECTS.RightIcons):
             print u"已设置自动战斗！"
-            game.touchAt(122, 1968)
-            game.pause(0.5)
+            game.schedule(ActionSequence(u"自动战斗按钮").tap(122, 1968).wait(0.5))
 
     def handle_normal(self):
         matcher = self.matcher
@@ -1207,15 +1474,12 @@ class JuQingGameLogic(BaseGameLogic):
             pos = matcher.match_sub_image_in_rect("./zhuzhan_icon.png", RECTS.BottomIcons)
             if pos:
                 print u"设置助战"
-                d = defer.Deferred()
-                d.addCallback(lambda _, *args: game.touchAt(*args), pos[0] + 40, pos[1] + 40)
-                d.addCallback(lambda _, *args: game.pause(*args), 10)
+                game.schedule(ActionSequence(u"设置助战").tap(pos[0] + 40, pos[1] + 40).wait(10))
 
             pos = matcher.match_sub_image_in_rect("./select_what_to_do_label.png", RECTS.Actions)
             if pos:
                 print u"选择要做的事"
-                game.touchAt(pos[0] - 130, pos[1] + 200)
-                game.pause(0.5)
+                game.schedule(ActionSequence(u"选择要做的事").tap(pos[0] - 130, pos[1] + 200).wait(0.5))
                 return
 
             pos = matcher.match_sub_image_in_rect("./hongchenshilian_label.png", RECTS.Tasks)
@@ -1277,6 +1541,14 @@ class JuQingGameLogic(BaseGameLogic):
 
 
 
+LOGICS = dict(
+    sanjieqiyuan = SanJieQiYuanGameLogic,
+    zhuogui = ZhuoGuiGameLogic,
+    routine = RoutineWorkGameLogic,
+    juqing = JuQingGameLogic,
+)
+
+
 # def loop_JuQing(game):
 
 #     width, height = game.width, game.height
@@ -1372,12 +1644,417 @@ class JuQingGameLogic(BaseGameLogic):
 
 #     return STOP_AFTER
 
+class DecisionTracer(object):
+    """最近若干帧决策记录的环形缓冲
+
+    每帧一条: 场景、检查过的规则及分数和耗时、点击位置、提交的动作序列、STOP_AFTER。
+    同一决策（场景/规则/点击/动作序列/STOP_AFTER 都相同）连续出现 repeat 次时, 把缓冲区
+    和当前画面写到 dump_dir。战斗、场景过渡以及只等待不点击的规则不算卡住。
+    """
+    def __init__(self, device, maxlen=200, repeat=10, dump_dir=None):
+        self.device = device
+        self.repeat = repeat
+        self.dump_dir = dump_dir
+        self.traces = collections.deque(maxlen=maxlen)
+        self.last_key = None
+        self.repeats = 0
+        self.dumped = False
+        self.dumps = 0
+
+    @staticmethod
+    def new_trace(frame):
+        return dict(t=time.time(), frame=frame, scene=None, rules=[], rule=None, touches=[],
+                    sequences=[])
+
+    def record(self, trace, game):
+        self.traces.append(trace)
+        waiting = trace["rule"] and not trace["touches"] and not trace["sequences"]
+        if trace["scene"] in ("battle", "transition") or waiting:
+            self.last_key = None
+            return
+        key = (trace["scene"], trace["rule"], tuple(trace["touches"]), tuple(trace["sequences"]),
+               trace["stop_after"])
+        if key != self.last_key:
+            self.last_key = key
+            self.repeats = 0
+            self.dumped = False
+        self.repeats += 1
+        if self.repeats >= self.repeat and not self.dumped and self.dump_dir:
+            self.dumped = True
+            self.dump(game)
+
+    def dump(self, game):
+        """写出 <device>-<时间>.<毫秒>-<序号>.json 和当前画面 .png"""
+        if not os.path.isdir(self.dump_dir):
+            os.makedirs(self.dump_dir)
+        now = time.time()
+        self.dumps += 1
+        path = os.path.join(self.dump_dir, "%s-%s.%03d-%d" % (
+            self.device, time.strftime("%Y%m%d-%H%M%S", time.localtime(now)),
+            int(now * 1000) % 1000, self.dumps))
+        with open(path + ".json", "w") as fp:
+            json.dump(dict(device=self.device, repeats=self.repeats, traces=list(self.traces)),
+                      fp, indent=1)
+        game.screen.save(path + ".png")
+        log.warning("%s: same decision %d times, trace dumped to %s.json", self.device,
+                    self.repeats, path)
+        return path
+
+
+class InputQueue(object):
+    """点击手势队列
+
+    每次点击是 按下(x, y) -> 保持 hold 秒 -> 抬起(x, y), 相邻点击间隔 gap 秒。
+    PointerEvent 本身带坐标, 所以不再单独发送 mouseMove; 与指针当前状态相同的事件
+    直接丢弃。同一时刻到期的事件拼成一次 transport.write 发出。
+    """
+    EVENT = struct.Struct("!BBHH")
+
+    def __init__(self, client, hold=0.02, gap=0.03):
+        self.client = client
+        self.hold = hold
+        self.gap = gap
+        # (发送前等待秒数, buttonmask, x, y)
+        self._steps = collections.deque()
+        self._timer = None
+
+        self.gestures = 0
+        self.events = 0
+        self.writes = 0
+        self.dropped = 0
+        # 队列非空的累计时间, 用于计算每秒点击数
+        self.busy_time = 0.0
+        self._busy_since = None
+
+    @property
+    def busy(self):
+        return self._timer is not None
+
+    @property
+    def rate(self):
+        """队列忙碌期间的每秒点击数"""
+        busy_time = self.busy_time
+        if self._busy_since is not None:
+            busy_time += time.time() - self._busy_since
+        return self.gestures / busy_time if busy_time else 0.0
+
+    def tap(self, x, y, button=1):
+        mask = 1 << (button - 1)
+        self._steps.append((self.gap if self.busy else 0.0, mask, x, y))
+        self._steps.append((self.hold, 0, x, y))
+        self.gestures += 1
+        if not self.busy:
+            self._busy_since = time.time()
+            # 本帧内接下来的点击也进入同一批
+            self._timer = reactor.callLater(0, self._send)
+
+    def pointer(self):
+        client = self.client
+        return getattr(client, "buttons", 0), getattr(client, "x", 0), getattr(client, "y", 0)
+
+    def _send(self):
+        client = self.client
+        pointer = self.pointer()
+        batch = []
+        first = True
+        while self._steps and (first or self._steps[0][0] <= 0):
+            first = False
+            _, mask, x, y = self._steps.popleft()
+            if (mask, x, y) == pointer:
+                self.dropped += 1
+                continue
+            pointer = (mask, x, y)
+            batch.append(self.EVENT.pack(5, mask, x, y))
+
+        if batch:
+            client.transport.write("".join(batch))
+            # 与 vncdotool 的指针状态保持一致
+            client.buttons, client.x, client.y = pointer
+            self.events += len(batch)
+            self.writes += 1
+
+        if self._steps:
+            self._timer = reactor.callLater(self._steps[0][0], self._send)
+        else:
+            self._timer = None
+            self.busy_time += time.time() - self._busy_since
+            self._busy_since = None
+
+    def cancel(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+            self.busy_time += time.time() - self._busy_since
+            self._busy_since = None
+        self._steps.clear()
+        # 不留下按着的键
+        buttons, x, y = self.pointer()
+        if buttons:
+            self.client.transport.write(self.EVENT.pack(5, 0, x, y))
+            self.client.buttons = 0
+
+
+class ActionScheduler(object):
+    """ActionSequence 的执行队列
+
+    序列按提交顺序逐个执行, 等待步骤用 reactor.callLater, 不阻塞 reactor。
+    点击交给 InputQueue, 其余输入和等待在前面的点击手势发完之后才开始。
+    序列执行期间新帧照常到达, check() 用序列的 guard 判断计划是否还成立。
+    """
+    # 序列执行期间请求新帧的间隔
+    POLL = 0.5
+
+    def __init__(self, client):
+        self.client = client
+        self._sequences = collections.deque()
+        self._steps = collections.deque()
+        self._timer = None
+        self.current = None
+
+        self.completed = 0
+        self.cancelled = 0
+
+    @property
+    def busy(self):
+        return self.current is not None
+
+    @property
+    def depth(self):
+        """未完成的序列数, 含正在执行的"""
+        return len(self._sequences) + (1 if self.current is not None else 0)
+
+    def run(self, sequence):
+        self._sequences.append(sequence)
+        if self.current is None:
+            self._next()
+
+    def _next(self):
+        if not self._sequences:
+            self.current = None
+            return
+        self.current = self._sequences.popleft()
+        self._steps = collections.deque(self.current.steps)
+        log.debug("%s: sequence %s started, %d steps", self.client.device,
+                  self.current.name, len(self._steps))
+        self._step()
+
+    def _step(self):
+        self._timer = None
+        input_queue = self.client.input_queue
+        while self._steps:
+            name, args, kwargs = self._steps[0]
+            if name != "touchAt" and input_queue.busy:
+                # 点击手势还没发完
+                self._timer = reactor.callLater(input_queue.gap, self._step)
+                return
+            self._steps.popleft()
+            if name == "wait":
+                self._timer = reactor.callLater(args[0], self._step)
+                return
+            try:
+                getattr(self.client, name)(*args, **kwargs)
+            except Exception:
+                log.exception("%s: sequence %s failed at %s", self.client.device,
+                              self.current.name, name)
+                self.cancel()
+                return
+        self.completed += 1
+        self._next()
+
+    def check(self, matcher):
+        """新帧到来时检查当前序列的 guard, 不成立则取消; 返回是否仍有序列在执行"""
+        sequence = self.current
+        if sequence is None:
+            return False
+        if sequence.guard is not None and not sequence.guard(matcher):
+            log.info("%s: sequence %s cancelled by new frame", self.client.device, sequence.name)
+            self.cancel()
+            return False
+        return True
+
+    def cancel(self):
+        """取消当前和排队中的序列, 以及还没发出的点击"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        count = self.depth
+        self._sequences.clear()
+        self._steps.clear()
+        self.current = None
+        if count:
+            self.cancelled += count
+            self.client.input_queue.cancel()
+        return count
+
+
+class FramePoller(object):
+    """决定下一次请求帧的时间
+
+    综合逻辑返回的等待时间、最近画面变化率和本帧是否有输入动作，
+    并记录实际的帧间隔分布。
+    """
+    # 变化率 (脏区域占全屏比例的滑动平均) 的阈值
+    BUSY = 0.2
+    IDLE = 0.01
+
+    def __init__(self, min_interval=0.1, max_interval=15.0, settle=1.0, history=500):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        # 有输入动作后至少等待画面响应的时间
+        self.settle = settle
+
+        self.change_rate = 0.0
+        self.idle_frames = 0
+
+        self.requested_at = None
+        self.intervals = collections.deque(maxlen=history)
+
+    def update(self, rectangles, screen_area):
+        area = sum(w * h for x, y, w, h in rectangles or ())
+        ratio = min(1.0, float(area) / screen_area) if screen_area else 1.0
+        self.change_rate = 0.7 * self.change_rate + 0.3 * ratio
+        if self.change_rate < self.IDLE:
+            self.idle_frames += 1
+        else:
+            self.idle_frames = 0
+
+    def next_delay(self, hint, acted=False):
+        """hint: 逻辑建议的等待时间, 0 表示立即重试"""
+        delay = hint
+        if self.change_rate > self.BUSY:
+            # 画面变化剧烈，尽快再看
+            delay *= 0.5
+        elif self.idle_frames:
+            # 画面静止，逐步放慢
+            delay *= min(1.5 ** self.idle_frames, 8.0)
+        if acted:
+            delay = max(delay, self.settle)
+        return max(self.min_interval, min(self.max_interval, delay))
+
+    def requested(self):
+        now = time.time()
+        if self.requested_at is not None:
+            self.intervals.append(now - self.requested_at)
+        self.requested_at = now
+
+    def percentile(self, p):
+        if not self.intervals:
+            return 0.0
+        values = sorted(self.intervals)
+        return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class CpuBudget(object):
+    """所有设备共享的匹配 CPU 配额
+
+    limit 为单核占用比例上限 (1.0 = 一个核), 超出时按需推迟下一帧。
+    """
+    def __init__(self, limit=None, window=10.0):
+        self.limit = limit
+        self.window = window
+        # (结束时间, 耗时)
+        self.samples = collections.deque()
+
+    def _expire(self, now):
+        while self.samples and self.samples[0][0] < now - self.window:
+            self.samples.popleft()
+
+    def charge(self, seconds):
+        now = time.time()
+        self.samples.append((now, seconds))
+        self._expire(now)
+
+    def usage(self):
+        self._expire(time.time())
+        return sum(t for _, t in self.samples) / self.window
+
+    def throttle(self):
+        """为了不超出配额还需额外等待的时间"""
+        if not self.limit:
+            return 0.0
+        used = self.usage() * self.window
+        allowed = self.limit * self.window
+        if used <= allowed:
+            return 0.0
+        return (used - allowed) / self.limit
+
+
+cpu_budget = CpuBudget()
+
+# 设备名 -> 已连接的 VNCXyqClient
+clients = dict()
+
+
 class VNCXyqClient(VNCDoToolClient, TimeoutMixin):
+    # 屏幕内容: RGB 的 numpy 数组, updateRectangle 原地写入
+    frame = None
+    # 灰度平面, 只在 gray_frame() 时更新脏区域
+    _gray = None
+    _gray_dirty = ()
+    pixel_format = pixfmt.get()
+
+    @property
+    def screen(self):
+        """PIL 视图，供 captureScreen / screen.save 使用（会复制一份）"""
+        if self.frame is None:
+            return None
+        return Image.fromarray(self.frame)
 
-    def timeoutConnection(self):
-        print "!!!!! 超时！"
-        reactor.callLater(0.1, reactor.stop)
+    @screen.setter
+    def screen(self, img):
+        if img is None:
+            self.frame = self._gray = None
+            return
+        self.frame = np.array(img.convert("RGB"))
+        self._gray = np.empty(self.frame.shape[:2], np.uint8)
+        self._gray_dirty = [(0, 0, img.size[0], img.size[1])]
 
+    def _ensure_frame(self, width, height):
+        if self.frame is not None and self.frame.shape[1] >= width and self.frame.shape[0] >= height:
+            return
+        # 屏幕变大（或第一次更新）时重新分配
+        old = self.frame
+        if old is not None:
+            width, height = max(width, old.shape[1]), max(height, old.shape[0])
+        self.frame = np.zeros((height, width, 3), np.uint8)
+        self._gray = np.zeros((height, width), np.uint8)
+        self._gray_dirty = [(0, 0, width, height)]
+        if old is not None:
+            self.frame[:old.shape[0], :old.shape[1]] = old
+
+    def updateRectangle(self, x, y, width, height, data):
+        # ignore empty updates
+        if not data:
+            return
+        self._ensure_frame(x + width, y + height)
+        rgb, gray = self.pixel_format.unpack(data, width, height)
+        self.frame[y: y + height, x: x + width] = rgb
+        if gray is None:
+            self._gray_dirty.append((x, y, width, height))
+        else:
+            # 低位深格式查表时直接得到灰度
+            self._gray[y: y + height, x: x + width] = gray
+
+    def drawCursor(self):
+        # 光标叠加会干扰模板匹配
+        pass
+
+    def gray_frame(self):
+        for x, y, w, h in self._gray_dirty:
+            self._gray[y: y + h, x: x + w] = cv2.cvtColor(self.frame[y: y + h, x: x + w],
+                                                          cv2.COLOR_RGB2GRAY)
+        self._gray_dirty = []
+        return self._gray
+
+    def pixel(self, x, y):
+        """(r, g, b)"""
+        return tuple(self.frame[y, x])
+
+    def timeoutConnection(self):
+        print "!!!!! 超时！", self.device
+        if getattr(self.factory, "device_conf", None) is None:
+            reactor.callLater(0.1, reactor.stop)
+        # 多设备模式下由 DeviceFactory.clientConnectionLost 重连这一台
         self.transport.abortConnection()
 
 
@@ -1389,11 +2066,60 @@ class VNCXyqClient(VNCDoToolClient, TimeoutMixin):
         self.counter = 0
         self.status = dict()
         self.switching = False
-
-        # self.setPixelFormat(bpp=8, depth=8, bigendian=0, truecolor=1,
-        #     redmax=7,   greenmax=7,   bluemax=3,
-        #     redshift=5, greenshift=2, blueshift=0
-        # )
+        self.logic = getattr(self.factory, "logic", None)
+        self.device = getattr(self.factory, "device", conf.ip)
+        self.connected_at = time.time()
+        # 匹配/决策累计耗时
+        self.busy_time = 0.0
+        clients[self.device] = self
+        self.match_cache = MatchCache()
+        self.metrics = metrics.Metrics(self.device, RECT_NAMES)
+        # 每帧的决策记录, 同一决策重复多次时落盘
+        self.tracer = DecisionTracer(self.device, getattr(conf, "trace_size", 200),
+                                     getattr(conf, "stuck_repeat", 10),
+                                     getattr(conf, "trace_dump_dir", None))
+        self.trace = None
+        # conf.account_pool 开启时租用的帐号
+        self.account = None
+        self.leased_at = None
+        self.heartbeat_at = 0
+        # 逻辑声明的下次刷新区域, 见 watch()
+        self.watched = None
+        self.full_requested_at = time.time()
+        # 最近一次请求的区域面积, 变化率按它计算
+        self.requested_area = self.width * self.height
+        self.first_action_at = None
+
+        self.poller = FramePoller(getattr(conf, "poll_min", 0.1),
+                                  getattr(conf, "poll_max", 15.0),
+                                  getattr(conf, "poll_settle", 1.0))
+        # touchAt 调用计数
+        self.actions = 0
+        self.input_queue = InputQueue(self, getattr(conf, "tap_hold", 0.02),
+                                      getattr(conf, "tap_gap", 0.03))
+        self.scheduler = ActionScheduler(self)
+
+        # 未变化帧跳过决策: (关注区域, hash), 以及计数
+        self.frame_digest = (None, None)
+        self.last_decision = None
+        self.evaluated_at = 0
+        self.skipped = 0
+        self.evaluated = 0
+
+        # conf.analysis = "thread" 时: 是否有分析在进行, 帧代数, 被丢弃的结果数
+        self.analyzing = False
+        self.generation = 0
+        self.dropped = 0
+        self.drop_streak = 0
+        # 分析中或等待时间内收到、还没决策的帧的脏矩形; 下次决策不早于 decide_after
+        self.held = None
+        self.decide_after = 0
+        # 唯一待执行的 pollFrame, 见 schedulePoll()
+        self.poll_call = None
+
+        # 旧版 vncdotool 不调用 setImageMode
+        if "pixel_format" not in self.__dict__:
+            self.setImageMode()
 
         #self.status['finished'] = True
 
@@ -1401,13 +2127,127 @@ class VNCXyqClient(VNCDoToolClient, TimeoutMixin):
         # self.switching = True
         # self.status = {'switch_account_stage': 3}
 
+    def setImageMode(self):
+        """vncdotool 在请求第一帧之前调用
+
+        总是发送自己的像素格式, rgb888 也一样: 解码按 RGBX 顺序进行, 不能依赖
+        服务器的默认格式。降低图片质量: rgb565 / rgb332, 见 pixfmt.py
+        """
+        self.pixel_format = pixfmt.get(getattr(conf, "pixel_format", None))
+        self.setPixelFormat(**self.pixel_format.params)
+
+    def watch(self, *rects):
+        """当前逻辑声明下一帧只需要这些区域"""
+        self.watched = list(rects)
+
+    def requestFrame(self):
+        # 定期全屏刷新，防止关注区域之外的变化被遗漏
+        interval = getattr(conf, "full_refresh_interval", 30.0)
+        if self.watched and time.time() - self.full_requested_at < interval:
+            x, y, w, h = bounding_rect(self.watched)
+            x, y = max(0, x), max(0, y)
+            w, h = min(w, self.width - x), min(h, self.height - y)
+            self.requested_area = w * h
+            self.framebufferUpdateRequest(x, y, w, h, incremental=1)
+        elif self.watched:
+            self.full_requested_at = time.time()
+            self.requested_area = self.width * self.height
+            self.framebufferUpdateRequest(incremental=0)
+        else:
+            self.full_requested_at = time.time()
+            self.requested_area = self.width * self.height
+            self.framebufferUpdateRequest(incremental=1)
+
+    def schedulePoll(self, delay):
+        """安排下一次 pollFrame, 只保留最近安排的一个"""
+        if self.poll_call is not None and self.poll_call.active():
+            self.poll_call.cancel()
+        self.poll_call = reactor.callLater(max(delay, 0), self.pollFrame)
+
+    def pollFrame(self, scheduled_at=None):
+        self.poll_call = None
+        scheduled_at = scheduled_at or time.time()
+        # 点击手势未发完时画面还在变化, 稍后再请求
+        if self.input_queue.busy and \
+           time.time() - scheduled_at < self.poller.max_interval:
+            self.poll_call = reactor.callLater(self.poller.min_interval, self.pollFrame, scheduled_at)
+            return
+        if self.held is not None and not self.analyzing:
+            # 已经收到的帧到了决策时间, 直接处理, 不必再请求
+            rectangles, self.held = self.held, None
+            self.processFrame(rectangles, time.time(), self.actions)
+            return
+        self.poller.requested()
+        self.requestFrame()
+
+    def create_matcher(self, store=None):
+        return OpenCVImageMatcher(self.frame, store, cache=self.match_cache,
+                                  pyramid=getattr(conf, "pyramid_scale", None),
+                                  gray=self.gray_frame(), metrics=self.metrics, trace=self.trace)
+
     def touchAt(self, x, y):
+        if self.first_action_at is None:
+            self.first_action_at = time.time()
+            started_at = getattr(self.factory, "started_at", None)
+            if started_at:
+                log.info("time-to-first-action: %.3fs", self.first_action_at - started_at)
         # 1960, 1260
+        self.actions += 1
+        if self.trace is not None:
+            self.trace["touches"].append((x, y))
         x = x + random.randint(-10, 10)
         y = y + random.randint(-10, 20)
-        self.mouseMove(x, y)
-        self.pause(0.2)
-        self.mousePress(1)
+        # 原来的 mouseMove, pause(0.2), mousePress 中 pause 返回的 Deferred 被丢弃,
+        # 并不会等待; 现在由 InputQueue 按 tap_hold / tap_gap 真正控制节奏
+        self.input_queue.tap(x, y)
+
+    def schedule(self, sequence):
+        """提交一个 ActionSequence, 不等待其执行"""
+        if self.trace is not None:
+            self.trace["sequences"].append(sequence.name)
+        self.scheduler.run(sequence)
+
+    def leaseAccount(self):
+        """切换帐号时租用下一个帐号, 未开启 conf.account_pool 时返回 None"""
+        if self.account is None and getattr(conf, "account_pool", False):
+            import db
+            self.account = db.lease(self.device, getattr(conf, "account_lease_time", 600))
+            if self.account is not None:
+                self.leased_at = datetime.datetime.now()
+                self.heartbeat_at = time.time()
+                log.info("%s: leased account %s", self.device, self.account.email)
+            else:
+                print u"没有可用帐号，等待"
+        return self.account
+
+    def finishAccount(self):
+        """当前帐号日常完成: 记录 RoutineWork 并归还租约"""
+        if self.account is None:
+            return
+        import db
+        self.account.finish_routine_work(self.leased_at)
+        db.release(self.account, self.device)
+        log.info("%s: released account %s", self.device, self.account.email)
+        self.account = None
+
+    def keepLease(self):
+        seconds = getattr(conf, "account_lease_time", 600)
+        if self.account is None or time.time() - self.heartbeat_at < seconds / 3.0:
+            return
+        import db
+        self.heartbeat_at = time.time()
+        if not db.heartbeat(self.account, self.device, seconds):
+            log.warning("%s: lease on account %s expired", self.device, self.account.email)
+
+    def stats(self):
+        """吞吐统计, 按每分钟计"""
+        minutes = max(time.time() - self.connected_at, 1.0) / 60.0
+        return dict(device=self.device, frames=self.counter / minutes,
+                    decisions=self.evaluated / minutes, actions=self.actions / minutes,
+                    cpu=self.busy_time / (minutes * 60.0) * 100,
+                    taps_per_second=self.input_queue.rate,
+                    sequences=self.scheduler.completed / minutes,
+                    cancelled=self.scheduler.cancelled)
 
     def vncRequestPassword(self):
         if self.factory.password is None:
@@ -1436,65 +2276,285 @@ class VNCXyqClient(VNCDoToolClient, TimeoutMixin):
                           incremental=1)
 
         self.resetTimeout()
-    # looping
-    def commitUpdate(self, rectangles):
-        self.counter += 1
-        start_time = time.time()
-
-        if self.switching:
-            if self.status.get('finished', False):
-                self.switching = False
-                self.status = dict()
-                sleep_after = loop(self)
+    def frame_hash(self, rects=None, gray=None):
+        if gray is None:
+            gray = self.gray_frame()
+        if not rects:
+            return zlib.adler32(gray.data)
+        digest = 1
+        for x, y, w, h in rects:
+            digest = zlib.adler32(np.ascontiguousarray(gray[y: y + h, x: x + w]).data, digest)
+        return digest
+
+    def frameUnchanged(self, rectangles):
+        """与上次决策时相比, 逻辑关注的区域是否没有变化"""
+        regions, digest = self.frame_digest
+        if digest is None or rectangles is None:
+            return False
+        if not rectangles:
+            return True
+        # 脏矩形都不在关注区域内, 不必计算 hash
+        if regions and not any(rect_intersects(r, dirty) for r in regions for dirty in rectangles):
+            return True
+        return self.frame_hash(regions) == digest
+
+    def decide(self, game=None):
+        """运行当前逻辑, 返回 (等待时间, 决策记录)
+
+        game 为 RecordingGame 时只记录动作, status / switching 的变化也只写在 game 上。
+        """
+        game = game or self
+        trace = game.trace = DecisionTracer.new_trace(self.counter)
+        if game.switching:
+            if game.status.get('finished', False):
+                game.switching = False
+                game.status = dict()
+                stage, func = "loop", loop
             else:
                 print u"切换帐号逻辑！"
-                sleep_after = loop_SwitchAccount(self)
+                stage, func = "loop_SwitchAccount", loop_SwitchAccount
         else:
-            if self.status.get('finished', False):
-                self.switching = True
+            if game.status.get('finished', False):
+                game.switching = True
                 print u"启动切换帐号逻辑"
-                self.status = dict()
-                sleep_after = loop_SwitchAccount(self)
+                game.finishAccount()
+                game.status = dict()
+                stage, func = "loop_SwitchAccount", loop_SwitchAccount
+            elif self.logic is not None:
+                stage, func = type(self.logic).__name__ + ".loop", self.logic.loop
             else:
-                sleep_after = loop(self)
+                stage, func = "loop", loop
+        with self.metrics.stage(stage):
+            sleep_after = func(game)
         #sleep_after = loop_JuQing(self)
 
         #sleep_after = loop_ZhuaGui(self)
-        sleep_after = sleep_after or 0.1
-        print '#', time.ctime(), "tt=%.3fs" % (time.time() - start_time), \
-            "wait=%.1fs" % sleep_after, "cnt=%d" % self.counter, self.status
+        game.trace = None
+        if game is not self:
+            trace["touches"] = [args for name, args, _ in game.recorded if name == "touchAt"]
+            trace["sequences"] = [args[0].name for name, args, _ in game.recorded
+                                  if name == "schedule"]
+        trace["logic"] = stage
+        trace["stop_after"] = sleep_after
+        return sleep_after or 0.1, trace
+
+    def _decideInThread(self, game):
+        """逻辑状态在决策后还原, 新状态交给 game, 结果被采用时由 replay() 写回"""
+        logic = self.logic
+        saved = logic.get_state() if logic is not None else None
+        start_time = time.time()
+        try:
+            sleep_after, trace = self.decide(game)
+        finally:
+            if logic is not None:
+                game.logic_state = logic.get_state()
+                logic.set_state(saved)
+        return sleep_after, trace, time.time() - start_time
+
+    # looping
+    def commitUpdate(self, rectangles):
+        self.counter += 1
+        start_time = time.time()
 
+        self.match_cache.invalidate(rectangles)
+        # 只请求了关注区域时, 按该区域而不是全屏计算变化率
+        self.poller.update(rectangles, self.requested_area)
+
+        if getattr(conf, "analysis", "reactor") == "thread" and \
+           (self.analyzing or time.time() < self.decide_after):
+            self.holdFrame(rectangles)
+        else:
+            self.processFrame(rectangles, start_time, self.actions)
+
+    def holdFrame(self, rectangles):
+        """分析进行中或还在上次决策的等待时间内到达的帧: 先收下, 进行中的分析结果作废"""
+        self.generation += 1
+        self.held = (self.held or []) + list(rectangles or ())
         VNCDoToolClient.commitUpdate(self, rectangles)
+        if self.analyzing:
+            # 分析期间继续请求新帧
+            self.schedulePoll(self.poller.min_interval)
+        else:
+            self.schedulePoll(self.decide_after - time.time())
+        self.resetTimeout()
 
-        reactor.callLater(sleep_after + 1,
-                          self.framebufferUpdateRequest,
-                          incremental=1)
+    def processFrame(self, rectangles, start_time, actions):
+        # 动作序列执行中且画面与计划不矛盾, 等序列完成再决策
+        if self.scheduler.busy and self.scheduler.check(self.create_matcher()):
+            self.skipped += 1
+            self.finishFrame(rectangles, ActionScheduler.POLL, time.time() - start_time, actions)
+        # 画面没变就沿用上次的决策，最多沿用 max_stale 秒
+        elif self.frameUnchanged(rectangles) and \
+           time.time() - self.evaluated_at < getattr(conf, "max_stale", 20.0):
+            self.skipped += 1
+            self.finishFrame(rectangles, self.last_decision, time.time() - start_time, actions)
+        elif getattr(conf, "analysis", "reactor") == "thread":
+            self.analyze(rectangles, actions)
+        else:
+            self.watched = None
+            sleep_after, trace = self.decide()
+            self.tracer.record(trace, self)
+            self.decided(sleep_after, self.frame_hash)
+            self.finishFrame(rectangles, sleep_after, time.time() - start_time, actions)
+
+    def analyze(self, rectangles, actions):
+        """在线程池中分析当前帧的快照, reactor 线程不被阻塞"""
+        game = RecordingGame(self, self.frame.copy(), self.gray_frame().copy())
+        self.analyzing = True
+        d = threads.deferToThread(self._decideInThread, game)
+        d.addCallbacks(self._analyzed, self._analyzeFailed,
+                       callbackArgs=(game, self.generation, rectangles, actions))
+        VNCDoToolClient.commitUpdate(self, rectangles)
+        # 分析期间继续请求新帧, 新帧到达时当前分析作废
+        self.schedulePoll(self.poller.min_interval)
+
+    def _analyzed(self, result, game, generation, rectangles, actions):
+        self.analyzing = False
+        # 画面一直在变时连续丢弃会永远无法决策, 超过 analysis_max_drops 次就采用
+        if generation != self.generation and \
+           self.drop_streak < getattr(conf, "analysis_max_drops", 3):
+            self.drop_streak += 1
+            # 分析期间来了新帧, 丢弃旧结果, 分析最新的画面;
+            # 决策中的状态变化都在 game 上, 一并丢弃
+            self.dropped += 1
+            held, self.held = self.held or [], None
+            self.analyze(list(rectangles or ()) + held, actions)
+            return
+        self.drop_streak = 0
+        sleep_after, trace, elapsed = result
+        game.replay()
+        if game.lease_requested and self.account is not None:
+            # 逻辑看到的是租约之前的快照, 帐号已经到手, 不必按没有帐号等待
+            sleep_after = min(sleep_after, 1.0)
+        self.tracer.record(trace, game)
+        self.watched = game.watched
+        self.decided(sleep_after, lambda rects: self.frame_hash(rects, game.gray_frame()))
+        self.finishFrame(rectangles, sleep_after, elapsed, actions)
+
+    def _analyzeFailed(self, reason):
+        self.analyzing = False
+        log.error("frame analysis failed: %s", reason.getTraceback())
+        self.schedulePoll(1.0)
+
+    def decided(self, sleep_after, frame_hash):
+        self.evaluated += 1
+        self.evaluated_at = time.time()
+        self.last_decision = sleep_after
+        self.frame_digest = (self.watched, frame_hash(self.watched))
+
+    def finishFrame(self, rectangles, sleep_after, elapsed, actions):
+        self.busy_time += elapsed
+        cpu_budget.charge(elapsed)
+
+        self.keepLease()
+        acted = self.actions > actions or self.scheduler.busy
+        delay = self.poller.next_delay(sleep_after, acted) + cpu_budget.throttle()
+        print '#', self.device, time.ctime(), "tt=%.3fs" % elapsed, \
+            "wait=%.1fs" % delay, "hint=%.1fs" % sleep_after, \
+            "poll=%.1f/%.1fs" % (self.poller.percentile(0.5), self.poller.percentile(0.9)), \
+            "cnt=%d" % self.counter, "skip=%d/%d" % (self.skipped, self.evaluated), \
+            "q=%d" % self.scheduler.depth, \
+            "drop=%d" % self.dropped, \
+            "tpl=%(hits)d/%(misses)d" % templates.store.stats(), \
+            "scene=%(hits)d/%(misses)d" % scene_cache.stats(), \
+            "match=%(computed)d/saved=%(saved)d" % OpenCVImageMatcher.counters, \
+            "dirty=%d" % len(rectangles or ()), self.status
+
+        VNCDoToolClient.commitUpdate(self, rectangles)
+
+        self.decide_after = time.time() + delay
+        self.schedulePoll(delay)
         self.resetTimeout()
 
 
-    def bad_updateRectangle(self, x, y, width, height, data):
-        # ignore empty updates
-        if not data:
-            return
+INPUT_METHODS = ("touchAt", "mouseMove", "mouseDown", "mouseUp", "mouseDrag",
+                 "mousePress", "keyPress", "keyEvent", "pause", "schedule")
 
-        size = (width, height)
-        print len(data), width, height
-        update = Image.frombytes('L', size, data, 'raw', 'F;8')
-        if not self.screen:
-            self.screen = update
-        # track upward screen resizes, often occurs during os boot of VMs
-        # When the screen is sent in chunks (as observed on VMWare ESXi), the canvas
-        # needs to be resized to fit all existing contents and the update.
-        elif self.screen.size[0] < (x+width) or self.screen.size[1] < (y+height):
-            new_size = (max(x+width, self.screen.size[0]), max(y+height, self.screen.size[1]))
-            new_screen = Image.new("RGB", new_size, "black")
-            new_screen.paste(self.screen, (0, 0))
-            new_screen.paste(update, (x, y))
-            self.screen = new_screen
-        else:
-            self.screen.paste(update, (x, y))
 
-        self.drawCursor()
+class RecordingGame(object):
+    """给逻辑用的游戏对象替身
+
+    持有一帧画面快照, 输入动作和 schedule() 提交的动作序列只记录不发送;
+    status / switching / 逻辑状态在副本上修改。replay() 时先写回状态,
+    再按顺序把输入转发给 client; 结果被丢弃时 client 不受影响。
+    client 为 None 时只记录, 用于离线回放。
+    """
+    def __init__(self, client, frame, gray=None):
+        self.client = client
+        self.frame = frame
+        self._gray = gray if gray is not None else cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+        self.height, self.width = frame.shape[:2]
+        if client is not None:
+            self.status = copy.deepcopy(client.status)
+            self.switching = client.switching
+        else:
+            self.status = dict()
+            self.switching = False
+        self.account = client.account if client is not None else None
+        self.logic_state = None
+        self.account_finished = False
+        self.lease_requested = False
+
+        self.recorded = []
+        self.replayed = False
+        self.watched = None
+        self.trace = None
+
+    @property
+    def screen(self):
+        return Image.fromarray(self.frame)
+
+    def gray_frame(self):
+        return self._gray
+
+    def pixel(self, x, y):
+        return tuple(self.frame[y, x])
+
+    def watch(self, *rects):
+        self.watched = list(rects)
+
+    def leaseAccount(self):
+        # 已租到的帐号直接用快照; 否则只记录请求, 由 replay() 在 reactor 上租用,
+        # 避免工作线程和 keepLease / finishAccount 同时改租约字段
+        if self.account is None:
+            self.lease_requested = True
+        return self.account
+
+    def finishAccount(self):
+        self.account_finished = True
+
+    def create_matcher(self, store=None):
+        # 快照只用一次, 使用帧内缓存即可
+        return OpenCVImageMatcher(self.frame, store, pyramid=getattr(conf, "pyramid_scale", None),
+                                  gray=self._gray,
+                                  metrics=self.client.metrics if self.client is not None else None,
+                                  trace=self.trace)
+
+    def replay(self):
+        client = self.client
+        client.status = self.status
+        client.switching = self.switching
+        if self.logic_state is not None:
+            client.logic.set_state(self.logic_state)
+        if self.account_finished:
+            client.finishAccount()
+        if self.lease_requested:
+            client.leaseAccount()
+        for name, args, kwargs in self.recorded:
+            getattr(self.client, name)(*args, **kwargs)
+        self.replayed = True
+
+
+def _recorded_input(name):
+    def method(self, *args, **kwargs):
+        if self.replayed:
+            return getattr(self.client, name)(*args, **kwargs)
+        self.recorded.append((name, args, kwargs))
+    method.__name__ = name
+    return method
+
+for _name in INPUT_METHODS:
+    setattr(RecordingGame, _name, _recorded_input(_name))
 
 
 class ExitingProcess(protocol.ProcessProtocol):
@@ -1609,6 +2669,67 @@ def build_tool():
     return factory
 
 
+# 多设备模式下连接失败/超时后的重连间隔
+RECONNECT_DELAY = 30.0
+
+
+def create_logic(name):
+    if name:
+        return LOGICS[name]()
+    return None
+
+
+def device_error(reason, device):
+    log.error("device %s: %s", device["name"], reason.getErrorMessage())
+    clients.pop(device["name"], None)
+    reactor.callLater(RECONNECT_DELAY, connect_device, device)
+
+
+class DeviceFactory(VNCDoToolFactory):
+    """多设备模式的连接: 连接失败走 factory.deferred 的 errback,
+    连上之后断开（超时、服务器关闭连接）在这里重连"""
+    def clientConnectionLost(self, connector, reason):
+        VNCDoToolFactory.clientConnectionLost(self, connector, reason)
+        device_error(reason, self.device_conf)
+
+
+def connect_device(device):
+    """多设备模式: 每台设备一个连接, 各自的 GameLogic 实例和 status, 共享模板库"""
+    factory = DeviceFactory()
+    factory.protocol = VNCXyqClient
+    factory.device = device["name"]
+    factory.device_conf = device
+    factory.password = device.get("password", conf.password)
+    factory.logic = create_logic(device.get("logic"))
+    factory.started_at = time.time()
+
+    factory.deferred.addCallbacks(log_connected)
+    build_command_list(factory, ["capture", "2-%s.png" % device["name"]], False, False)
+    factory.deferred.addErrback(device_error, device)
+
+    reactor.connectTCP(device["ip"], device.get("port", 5900), factory)
+    return factory
+
+
+def log_stats():
+    for name in sorted(clients):
+        log.info("%(device)s: %(frames).1f frames/min, %(decisions).1f decisions/min, "
+                 "%(actions).1f actions/min, %(taps_per_second).1f taps/s while tapping, "
+                 "%(sequences).1f sequences/min, %(cancelled)d cancelled, cpu=%(cpu).1f%%", clients[name].stats())
+    log.info("matching cpu: %.1f%% of one core", cpu_budget.usage() * 100)
+    for name in sorted(clients):
+        for line in clients[name].metrics.summary():
+            log.info(line)
+    rules.report()
+
+
+def build_devices(devices):
+    for device in devices:
+        connect_device(device)
+
+    reactor.exit_status = 1
+
+
 def setup_logging(logfile=None, verbose=False):
     # route Twisted log messages via stdlib logging
     if logfile:
@@ -1644,12 +2765,66 @@ def parse_host(server):
     return host, port
 
 
-def vncdo():
-    setup_logging("./my.log", verbose=True)
+def load_templates(logics=(None,)):
+    if any(logic is None for logic in logics):
+        patterns = templates.TEMPLATE_PATTERNS
+    else:
+        patterns = sorted(set(p for logic in logics for p in logic.TEMPLATES))
+    pack = getattr(conf, "template_pack", None)
+    templates.store.set_pixel_format(pixfmt.get(getattr(conf, "pixel_format", None)))
+
+    start_time = time.time()
+    count = 0
+    if pack and os.path.exists(pack):
+        try:
+            count = templates.store.load_pack(pack, patterns)
+            source = pack
+        except IOError, e:
+            log.warning("ignore template pack: %s", e)
+    if not count:
+        count = templates.store.preload(patterns)
+        source = "png"
+    log.info("loaded %d templates from %s in %.3fs", count, source, time.time() - start_time)
 
 
-    factory = build_tool()
-    factory.password = conf.password
+def vncdo():
+    setup_logging("./my.log", verbose=True)
+    started_at = time.time()
+
+    cpu_budget.limit = getattr(conf, "match_cpu_limit", None)
+    if getattr(conf, "analysis", "reactor") == "thread":
+        reactor.suggestThreadPoolSize(getattr(conf, "analysis_threads", 4))
+    devices = getattr(conf, "devices", None)
+    if devices:
+        # 只需要各逻辑类的 TEMPLATES, 实例在 connect_device 中创建
+        load_templates([LOGICS[device["logic"]] if device.get("logic") else None
+                        for device in devices])
+    else:
+        logic = create_logic(getattr(conf, "logic", None))
+        load_templates([logic])
+
+    if getattr(conf, "scene_seed_dir", None):
+        count = scene_cache.seed(conf.scene_seed_dir)
+        log.info("seeded scene cache with %d screenshots", count)
+
+    if getattr(conf, "account_pool", False):
+        import db
+        db.create()
+
+    stats_loop = task.LoopingCall(log_stats)
+    stats_loop.start(getattr(conf, "stats_interval", 60.0), now=False)
+    if getattr(conf, "metrics_port", None):
+        metrics.listen(reactor, conf.metrics_port,
+                       lambda: [clients[name].metrics for name in sorted(clients)])
+        log.info("metrics on http://127.0.0.1:%d/", conf.metrics_port)
+
+    if devices:
+        build_devices(devices)
+    else:
+        factory = build_tool()
+        factory.password = conf.password
+        factory.logic = logic
+        factory.started_at = started_at
 
     reactor.run()
 
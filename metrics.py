@@ -0,0 +1,170 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# #  FileName    : metrics.py
+# #  Author      : ShuYu Wang <andelf@gmail.com>
+# #  Created     : Sun May 24 10:41:52 2015 by ShuYu Wang
+# #  Copyright   : Feather Workshop (c) 2015
+# #  Description : 模板匹配与逻辑各阶段的耗时统计
+
+import time
+import threading
+import contextlib
+
+from twisted.web import server, resource
+
+
+# 最佳分数分布的桶上界
+SCORE_BUCKETS = (0.2, 0.4, 0.6, 0.7, 0.8, 0.9, 0.95, 1.0)
+
+
+class Counter(object):
+    """次数 / 总耗时 / 最大耗时"""
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+
+class MatchCounter(Counter):
+    """单个 (模板, rect): 实际匹配的耗时和分数分布, 以及阈值判定的命中率"""
+    __slots__ = ("checks", "hits", "buckets")
+
+    def __init__(self):
+        super(MatchCounter, self).__init__()
+        self.checks = 0
+        self.hits = 0
+        self.buckets = [0] * len(SCORE_BUCKETS)
+
+    def add_score(self, seconds, score):
+        self.add(seconds)
+        for i, bound in enumerate(SCORE_BUCKETS):
+            if score <= bound:
+                self.buckets[i] += 1
+                break
+
+    @property
+    def hit_rate(self):
+        return float(self.hits) / self.checks if self.checks else 0.0
+
+
+class Metrics(object):
+    """一台设备的统计
+
+    match(): OpenCVImageMatcher 每次实际执行 matchTemplate 后调用
+    check(): 分数与阈值比较之后调用, 帧内缓存命中的也计入
+    stage(): 逻辑阶段计时, 如 is_battle, handle_normal
+    """
+    def __init__(self, device="-", rect_names=None):
+        self.device = device
+        self.rect_names = rect_names or dict()
+        self.started_at = time.time()
+        self._matches = dict()
+        self._stages = dict()
+        # 分析线程写, reactor 线程读
+        self._lock = threading.Lock()
+
+    def rect_name(self, rect):
+        if rect is None:
+            return "full"
+        return self.rect_names.get(rect) or "%d,%d,%d,%d" % rect
+
+    def _match_counter(self, key):
+        counter = self._matches.get(key)
+        if counter is None:
+            counter = self._matches[key] = MatchCounter()
+        return counter
+
+    def match(self, key, seconds, score):
+        with self._lock:
+            self._match_counter(key).add_score(seconds, score)
+
+    def check(self, key, hit):
+        with self._lock:
+            counter = self._match_counter(key)
+            counter.checks += 1
+            if hit:
+                counter.hits += 1
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start_time
+            with self._lock:
+                counter = self._stages.get(name)
+                if counter is None:
+                    counter = self._stages[name] = Counter()
+                counter.add(elapsed)
+
+    def top_matches(self, limit=None):
+        """按总耗时排序: [((模板, rect), MatchCounter), ...]"""
+        with self._lock:
+            items = sorted(self._matches.items(), key=lambda item: item[1].total, reverse=True)
+        return items[:limit] if limit else items
+
+    def stages(self):
+        with self._lock:
+            return sorted(self._stages.items(), key=lambda item: item[1].total, reverse=True)
+
+    def summary(self, limit=5):
+        """日志用的简短摘要"""
+        lines = []
+        for (name, rect), c in self.top_matches(limit):
+            lines.append("%s match %s@%s: %d calls, %.3fs total, %.1fms max, hit %.0f%%" % (
+                self.device, name, self.rect_name(rect), c.count, c.total, c.max * 1000,
+                c.hit_rate * 100))
+        for name, c in self.stages()[:limit]:
+            lines.append("%s stage %s: %d calls, %.3fs total, %.1fms max" % (
+                self.device, name, c.count, c.total, c.max * 1000))
+        return lines
+
+    def render(self):
+        """纯文本指标, 一行一个值"""
+        lines = []
+        for (name, rect), c in self.top_matches():
+            labels = 'device="%s",template="%s",rect="%s"' % (self.device, name, self.rect_name(rect))
+            lines.append("xyq_match_calls{%s} %d" % (labels, c.count))
+            lines.append("xyq_match_seconds_total{%s} %.6f" % (labels, c.total))
+            lines.append("xyq_match_seconds_max{%s} %.6f" % (labels, c.max))
+            lines.append("xyq_match_checks{%s} %d" % (labels, c.checks))
+            lines.append("xyq_match_hits{%s} %d" % (labels, c.hits))
+            cumulative = 0
+            for bound, count in zip(SCORE_BUCKETS, c.buckets):
+                cumulative += count
+                lines.append('xyq_match_score_bucket{%s,le="%.2f"} %d' % (labels, bound, cumulative))
+        for name, c in self.stages():
+            labels = 'device="%s",stage="%s"' % (self.device, name)
+            lines.append("xyq_stage_calls{%s} %d" % (labels, c.count))
+            lines.append("xyq_stage_seconds_total{%s} %.6f" % (labels, c.total))
+            lines.append("xyq_stage_seconds_max{%s} %.6f" % (labels, c.max))
+        return lines
+
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, collect):
+        resource.Resource.__init__(self)
+        # collect() 返回当前所有 Metrics
+        self.collect = collect
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "text/plain; charset=utf-8")
+        lines = []
+        for metrics in self.collect():
+            lines.extend(metrics.render())
+        return "\n".join(lines) + "\n"
+
+
+def listen(reactor, port, collect, interface="127.0.0.1"):
+    return reactor.listenTCP(port, server.Site(MetricsResource(collect)), interface=interface)
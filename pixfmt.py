@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# #  FileName    : pixfmt.py
+# #  Author      : ShuYu Wang <andelf@gmail.com>
+# #  Created     : Thu May 21 15:40:18 2015 by ShuYu Wang
+# #  Copyright   : Feather Workshop (c) 2015
+# #  Description : RFB 像素格式, 降低图片质量以减少 VNC 流量
+
+import cv2
+import numpy as np
+
+
+# setPixelFormat 参数
+FORMATS = dict(
+    rgb888 = dict(bpp=32, depth=24, bigendian=0, truecolor=1,
+                  redmax=255, greenmax=255, bluemax=255,
+                  redshift=0, greenshift=8, blueshift=16),
+    rgb565 = dict(bpp=16, depth=16, bigendian=0, truecolor=1,
+                  redmax=31, greenmax=63, bluemax=31,
+                  redshift=11, greenshift=5, blueshift=0),
+    rgb332 = dict(bpp=8, depth=8, bigendian=0, truecolor=1,
+                  redmax=7, greenmax=7, bluemax=3,
+                  redshift=5, greenshift=2, blueshift=0),
+)
+
+
+class PixelFormat(object):
+    """像素格式及其解码
+
+    低位深格式用查表解码: 像素值 -> RGB / 灰度, 整个矩形一次 numpy 索引完成。
+    模板用 quantize() 做同样的量化, 保证匹配阈值仍然有效。
+    """
+    def __init__(self, name, params=None):
+        self.name = name
+        self.params = params or FORMATS[name]
+        self.bpp = self.params["bpp"]
+        self.lowbit = self.bpp < 32
+
+        if self.lowbit:
+            self.dtype = np.dtype("<u1" if self.bpp == 8 else "<u2")
+            values = np.arange(1 << self.bpp, dtype=np.uint32)
+            rgb = np.empty((len(values), 3), np.uint8)
+            for i, c in enumerate(("red", "green", "blue")):
+                cmax, cshift = self.params[c + "max"], self.params[c + "shift"]
+                rgb[:, i] = ((values >> cshift) & cmax) * 255 // cmax
+            self.rgb_lut = rgb
+            self.gray_lut = cv2.cvtColor(rgb.reshape((1, -1, 3)), cv2.COLOR_RGB2GRAY).reshape(-1)
+
+    def unpack(self, data, width, height):
+        """返回 (rgb, gray); 32 位格式 gray 为 None, 由调用者按需转换"""
+        if not self.lowbit:
+            pixels = np.frombuffer(data, np.uint8).reshape((height, width, 4))
+            return pixels[:, :, :3], None
+        index = np.frombuffer(data, self.dtype).reshape((height, width))
+        return self.rgb_lut[index], self.gray_lut[index]
+
+    def pack(self, bgr):
+        """BGR 图像 -> 像素值（截断低位, 与服务器端一致）"""
+        value = np.zeros(bgr.shape[:2], np.uint32)
+        for i, c in zip((2, 1, 0), ("red", "green", "blue")):
+            cmax, cshift = self.params[c + "max"], self.params[c + "shift"]
+            bits = len(bin(cmax)) - 2
+            value |= (bgr[:, :, i].astype(np.uint32) >> (8 - bits)) << cshift
+        return value
+
+    def tobytes(self, bgr):
+        """BGR 图像 -> 线上传输的像素数据, 服务器端使用"""
+        dtype = {8: "u1", 16: "u2", 32: "u4"}[self.bpp]
+        dtype = (">" if self.params.get("bigendian") else "<") + dtype
+        return self.pack(bgr).astype(dtype).tostring()
+
+    def quantize(self, bgr):
+        """BGR 模板 -> 经过同样量化的灰度图"""
+        if not self.lowbit:
+            return cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
+        return self.gray_lut[self.pack(bgr)]
+
+
+def get(name=None):
+    return PixelFormat(name or "rgb888")
+
+
+def from_params(params):
+    """SetPixelFormat 收到的参数 -> PixelFormat, 与 FORMATS 一致时沿用其名字"""
+    for name, known in FORMATS.items():
+        if all(params.get(key) == value for key, value in known.items()):
+            return PixelFormat(name)
+    return PixelFormat("custom", params)
@@ -0,0 +1,271 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# #  FileName    : templates.py
+# #  Author      : ShuYu Wang <andelf@gmail.com>
+# #  Created     : Wed May 20 19:02:11 2015 by ShuYu Wang
+# #  Copyright   : Feather Workshop (c) 2015
+# #  Description : template image registry
+
+import os
+import sys
+import glob
+import time
+import json
+import mmap
+import zlib
+import struct
+import fnmatch
+
+import cv2
+import numpy as np
+
+import pixfmt
+
+
+__dir__ = os.path.dirname(os.path.abspath(__file__))
+
+# 所有模板：根目录 UI 图标 + 三界奇缘题库
+TEMPLATE_PATTERNS = ("*.png", "sanjieqiyuan/*.png")
+
+# 根目录下的整屏截图（bench.py 回放用、启动时 capture 的 2.png）, 不是模板
+SCREENSHOTS = ("login.png", "sanjieqiyuan.png", "2.png")
+
+DEFAULT_PACK = os.path.join(__dir__, "templates.pack")
+
+# 文件头: magic, 索引长度; 随后是 JSON 索引, 数据区按 PACK_ALIGN 对齐
+PACK_MAGIC = "XYQTPL01"
+PACK_HEADER = struct.Struct("<8sI")
+PACK_ALIGN = 64
+
+
+def template_name(imgfile):
+    """./sanjieqiyuan/tang_seng.png -> sanjieqiyuan/tang_seng.png"""
+    name = os.path.normpath(imgfile)
+    if os.path.isabs(name):
+        name = os.path.relpath(name, __dir__)
+    return name.replace(os.sep, "/")
+
+
+def match_patterns(name, patterns):
+    """fnmatch，但 * 不跨目录"""
+    for pattern in patterns:
+        if name.count("/") == pattern.count("/") and fnmatch.fnmatch(name, pattern):
+            return True
+    return False
+
+
+def checksum(img):
+    return zlib.crc32(np.ascontiguousarray(img).data) & 0xffffffff
+
+
+def _align(n):
+    return (n + PACK_ALIGN - 1) // PACK_ALIGN * PACK_ALIGN
+
+
+class TemplateStore(object):
+    """解码后的灰度模板缓存
+
+    每个模板只解码一次，按名字取用。文件 mtime 变化时自动重新加载。
+    """
+    def __init__(self, root=__dir__, check_interval=1.0):
+        self.root = root
+        # 同一个模板两次 stat 之间的最小间隔（秒）
+        self.check_interval = check_interval
+
+        # name -> [mtime, checked_at, array]
+        self._entries = dict()
+        # (name, scale) -> (原始 array, 缩放后 array)
+        self._scaled = dict()
+
+        # 与 VNC 像素格式一致的量化方式
+        self.pixel_format = pixfmt.get()
+
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+    def path_of(self, name):
+        return os.path.join(self.root, name)
+
+    def _load(self, name):
+        path = self.path_of(name)
+        mtime = os.stat(path).st_mtime
+        if self.pixel_format.lowbit:
+            img = cv2.imread(path)
+            if img is not None:
+                img = self.pixel_format.quantize(img)
+        else:
+            img = cv2.imread(path, 0)
+        if img is None:
+            raise IOError("can not decode template: %s" % path)
+        self._entries[name] = [mtime, time.time(), img]
+        return img
+
+    def set_pixel_format(self, pixel_format):
+        if pixel_format.name != self.pixel_format.name:
+            self.pixel_format = pixel_format
+            self._entries.clear()
+            self._scaled.clear()
+
+    def get(self, imgfile):
+        name = template_name(imgfile)
+        entry = self._entries.get(name)
+        if entry is None:
+            self.misses += 1
+            return self._load(name)
+
+        now = time.time()
+        if now - entry[1] >= self.check_interval:
+            entry[1] = now
+            try:
+                mtime = os.stat(self.path_of(name)).st_mtime
+            except OSError:
+                # 文件被删掉了，继续用内存中的
+                mtime = entry[0]
+            if mtime != entry[0]:
+                self.reloads += 1
+                return self._load(name)
+
+        self.hits += 1
+        return entry[2]
+
+    def get_scaled(self, imgfile, scale):
+        """缩放后的模板，用于金字塔匹配；原模板重新加载后自动更新"""
+        img = self.get(imgfile)
+        key = (template_name(imgfile), scale)
+        entry = self._scaled.get(key)
+        if entry is None or entry[0] is not img:
+            scaled = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            entry = self._scaled[key] = (img, scaled)
+        return entry[1]
+
+    def names(self, patterns=TEMPLATE_PATTERNS):
+        result = []
+        for pattern in patterns:
+            for path in sorted(glob.glob(os.path.join(self.root, pattern))):
+                name = template_name(os.path.relpath(path, self.root))
+                if not match_patterns(name, SCREENSHOTS):
+                    result.append(name)
+        return result
+
+    def preload(self, patterns=TEMPLATE_PATTERNS):
+        """启动时一次性解码所有模板"""
+        count = 0
+        for name in self.names(patterns):
+            if name not in self._entries:
+                self._load(name)
+                count += 1
+        return count
+
+    def load_pack(self, path=DEFAULT_PACK, patterns=TEMPLATE_PATTERNS, verify=False):
+        """从预编译模板包 mmap 加载模板，只加载 patterns 匹配的部分
+
+        模板数组直接引用 mmap 内存，不复制。包内记录了源文件 mtime，
+        源文件更新后 get() 会自动从 PNG 重新解码。
+        """
+        fp = open(path, "rb")
+        try:
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fp.close()
+
+        magic, index_size = PACK_HEADER.unpack_from(mm, 0)
+        if magic != PACK_MAGIC:
+            raise IOError("bad template pack: %s" % path)
+        index = json.loads(mm[PACK_HEADER.size: PACK_HEADER.size + index_size])
+        if index.get("pixel_format", "rgb888") != self.pixel_format.name:
+            raise IOError("template pack %s is built for %s" % (path, index.get("pixel_format")))
+
+        now = time.time()
+        count = 0
+        for item in index["templates"]:
+            name = item["name"]
+            if not match_patterns(name, patterns) or match_patterns(name, SCREENSHOTS):
+                continue
+            h, w = item["shape"]
+            img = np.frombuffer(mm, dtype=np.uint8, count=h * w,
+                                offset=item["offset"]).reshape((h, w))
+            if verify and checksum(img) != item["checksum"]:
+                raise IOError("template pack checksum mismatch: %s" % name)
+            self._entries[name] = [item["mtime"], now, img]
+            count += 1
+        return count
+
+    def build_pack(self, path=DEFAULT_PACK, patterns=TEMPLATE_PATTERNS):
+        """把模板解码后打包成单个二进制文件"""
+        entries = []
+        for name in self.names(patterns):
+            self.get(name)
+            mtime, _, img = self._entries[name]
+            entries.append((name, mtime, np.ascontiguousarray(img)))
+
+        # 先用占位 offset 估算索引长度
+        def make_index(offsets):
+            return json.dumps(dict(version=1, pixel_format=self.pixel_format.name, templates=[
+                dict(name=name, shape=list(img.shape), offset=offset,
+                     mtime=mtime, checksum=checksum(img))
+                for (name, mtime, img), offset in zip(entries, offsets)]))
+
+        index = make_index([0] * len(entries))
+        while True:
+            offsets = []
+            offset = _align(PACK_HEADER.size + len(index))
+            for _, _, img in entries:
+                offsets.append(offset)
+                offset = _align(offset + img.nbytes)
+            new_index = make_index(offsets)
+            if len(new_index) <= len(index):
+                break
+            index = new_index
+        index = new_index.ljust(len(index))
+
+        with open(path + ".tmp", "wb") as fp:
+            fp.write(PACK_HEADER.pack(PACK_MAGIC, len(index)))
+            fp.write(index)
+            for (_, _, img), offset in zip(entries, offsets):
+                fp.write("\0" * (offset - fp.tell()))
+                fp.write(img.data)
+        os.rename(path + ".tmp", path)
+        return len(entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, imgfile):
+        return template_name(imgfile) in self._entries
+
+    def stats(self):
+        return dict(templates=len(self._entries), hits=self.hits,
+                    misses=self.misses, reloads=self.reloads)
+
+
+# 全局共享的模板库
+store = TemplateStore()
+
+
+def main(argv):
+    if len(argv) < 2 or argv[1] not in ("build", "bench"):
+        print "usage: %s build|bench [pack] [pixel_format]" % argv[0]
+        return 1
+
+    path = argv[2] if len(argv) > 2 else DEFAULT_PACK
+    if argv[1] == "build":
+        store = TemplateStore()
+        store.set_pixel_format(pixfmt.get(argv[3] if len(argv) > 3 else None))
+        count = store.build_pack(path)
+        print "packed %d %s templates into %s" % (count, store.pixel_format.name, path)
+        return 0
+
+    # 冷启动对比：逐个解码 PNG vs mmap 模板包
+    start_time = time.time()
+    count = TemplateStore().preload()
+    print "png:  %d templates in %.3fs" % (count, time.time() - start_time)
+
+    start_time = time.time()
+    count = TemplateStore().load_pack(path)
+    print "pack: %d templates in %.3fs" % (count, time.time() - start_time)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
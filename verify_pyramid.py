@@ -0,0 +1,71 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# #  FileName    : verify_pyramid.py
+# #  Author      : ShuYu Wang <andelf@gmail.com>
+# #  Created     : Thu May 21 10:12:40 2015 by ShuYu Wang
+# #  Copyright   : Feather Workshop (c) 2015
+# #  Description : 金字塔匹配与原图匹配结果对比
+
+import sys
+import time
+import optparse
+
+from PIL import Image
+
+from main import OpenCVImageMatcher
+
+
+# main.py 中做全屏搜索的模板
+FULL_SCREEN_TEMPLATES = [
+    "./close_icon.png",
+    "./chat_input.png",
+    "./login_game_button.png",
+    "./buy_button.png",
+    "./ok_button.png",
+    "./activity_info_popup_label.png",
+]
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] screenshot.png ...")
+    parser.add_option("-s", "--scale", type="float", default=0.5,
+                      help="pyramid scale (default 0.5)")
+    parser.add_option("-t", "--threshold", type="float", default=0.8,
+                      help="match threshold (default 0.8)")
+    options, args = parser.parse_args()
+    frames = args or ["./login.png", "./sanjieqiyuan.png"]
+
+    mismatches = 0
+    exact_time = pyramid_time = 0.0
+    for frame in frames:
+        img = Image.open(frame).convert("RGB")
+        exact = OpenCVImageMatcher(img)
+        pyramid = OpenCVImageMatcher(img, pyramid=options.scale)
+
+        for imgfile in FULL_SCREEN_TEMPLATES:
+            start_time = time.time()
+            exact_score, exact_pos = exact.match_best(imgfile)
+            exact_time += time.time() - start_time
+
+            start_time = time.time()
+            score, pos = pyramid.match_best(imgfile)
+            pyramid_time += time.time() - start_time
+
+            exact_hit = exact_score >= options.threshold
+            hit = score >= options.threshold
+            # 两者都命中时位置也必须一致
+            same = exact_hit == hit and (not hit or pos == exact_pos)
+            if not same:
+                mismatches += 1
+            print "%s %-40s exact=%.3f%s pyramid=%.3f%s %s" % (
+                "ok  " if same else "DIFF", frame + ":" + imgfile,
+                exact_score, exact_pos if exact_hit else "",
+                score, pos if hit else "", "" if same else "<--")
+
+    print "exact: %.3fs, pyramid(%.2f): %.3fs, mismatches: %d" % (
+        exact_time, options.scale, pyramid_time, mismatches)
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())